@@ -0,0 +1,83 @@
+# memory per product of the catalog held as peewee Product instances, as dicts and as the columnar store
+#
+#   python Benchmarks/catalog_memory_bench.py --products 1000000
+#
+# python heap is measured with tracemalloc, the columnar store lives in a memory-mapped file which is
+# shared by every worker, its size is reported separately
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import catalog_store  # noqa: E402
+from inf349 import Product  # noqa: E402
+
+TYPES = ["dairy", "vegetable", "fruit", "bakery", "vegan", "meat", "other"]
+
+
+def rows(count):
+    for i in range(1, count + 1):
+        yield (i, "Product %d" % i, TYPES[i % len(TYPES)], "Description of product %d" % i,
+               "%d.jpg" % i, i % 100, i % 3000, (i % 5000) / 100, i % 4 != 0)
+
+
+def measure(build):
+    tracemalloc.start()
+    started = time.perf_counter()
+    value = build()
+    elapsed = time.perf_counter() - started
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return value, size, elapsed
+
+
+def lookups(get, count, total=100000):
+    ids = [random.randint(1, count) for _ in range(total)]
+    started = time.perf_counter()
+    for product_id in ids:
+        get(product_id)
+    return (time.perf_counter() - started) / total * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=1000000)
+    parser.add_argument("--skip-models", action="store_true", help="peewee instances are slow to build")
+    args = parser.parse_args()
+    count = args.products
+
+    print("%-18s %14s %14s %10s %14s" % ("representation", "heap MB", "bytes/product", "build s", "lookup us"))
+
+    def report(name, size, elapsed, lookup, extra=""):
+        print("%-18s %14.1f %14.1f %10.2f %14.2f %s" % (name, size / 1e6, size / count, elapsed, lookup, extra))
+
+    if not args.skip_models:
+        models, size, elapsed = measure(lambda: {row[0]: Product(**dict(zip(catalog_store.FIELDS, row)))
+                                                 for row in rows(count)})
+        report("peewee instances", size, elapsed, lookups(models.get, count))
+        del models
+
+    dicts, size, elapsed = measure(lambda: {row[0]: dict(zip(catalog_store.FIELDS, row)) for row in rows(count)})
+    report("dicts by id", size, elapsed, lookups(dicts.get, count))
+    del dicts
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "catalog.bin")
+        started = time.perf_counter()
+        catalog_store.write_catalog(path, rows(count))
+        written = time.perf_counter() - started
+        store, size, elapsed = measure(lambda: catalog_store.ColumnarCatalog(path))
+        mapped = os.path.getsize(path)
+        report("columnar", size, written + elapsed, lookups(store.get, count),
+               "(+ %.1f MB mapped, %.1f bytes/product, shared)" % (mapped / 1e6, mapped / count))
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
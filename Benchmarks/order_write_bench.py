@@ -0,0 +1,69 @@
+# order creations per second with and without group commit
+#
+#   python Benchmarks/order_write_bench.py --threads 16 --duration 5
+#
+# runs create_order() from a pool of threads against a scratch database, the catalog is made up locally
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inf349  # noqa: E402
+
+
+def setup(directory):
+    inf349.create_app({'DATABASE': os.path.join(directory, "bench.db"),
+                       'ARCHIVE_DATABASE': os.path.join(directory, "archive.db"),
+                       'CATALOG_SNAPSHOT': os.path.join(directory, "catalog.json"),
+                       'CATALOG_STORE': os.path.join(directory, "catalog.bin")})
+    inf349.db.connect(reuse_if_open=True)
+    inf349.db.drop_tables(inf349.MODELS)
+    inf349.db.create_tables(inf349.MODELS)
+    inf349.Product.create(id=1, name="bench", type="other", description="", image="", height=1, weight=1,
+                          price=1, in_stock=True)
+    # create_order() checks the product against the store, not the table
+    inf349.build_catalog_store()
+    inf349.invalidate_catalog()
+    inf349.db.close()
+
+
+def run(group_commit, threads, duration):
+    counts = [0] * threads
+    stop = time.time() + duration
+
+    def client(index):
+        while time.time() < stop:
+            _, error = inf349.create_order({'id': 1, 'quantity': 1}, group_commit)
+            assert error is None
+            counts[index] += 1
+        inf349.db.close()
+
+    pool = [threading.Thread(target=client, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    inf349.close_order_writer()
+    return sum(counts) / duration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print("%14s %12s" % ("group commit", "orders/s"))
+        for group_commit in (False, True):
+            setup(directory)
+            print("%14s %12.1f" % ("on" if group_commit else "off", run(group_commit, args.threads, args.duration)))
+
+
+if __name__ == "__main__":
+    main()
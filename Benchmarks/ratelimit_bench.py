@@ -0,0 +1,84 @@
+# cost of the rate limiter itself
+#
+#   python Benchmarks/ratelimit_bench.py --threads 8 --duration 3 --clients 1000 100000
+#
+# first admit()/done() calls per second straight on the limiter, for a number of clients below and above what
+# the store keeps (10000 buckets), then requests per second through the flask app on GET /stats (no database
+# work) with and without the limiter, so the difference is only the limiter
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inf349  # noqa: E402
+from ratelimit import MemoryStore, RateLimiter  # noqa: E402
+
+# high enough that nothing is ever rejected, the point is to measure the bookkeeping
+LIMITS = {"*": (1e9, 1e9)}
+
+
+def run(threads, duration, call):
+    counts = [0] * threads
+    stop = time.time() + duration
+
+    def client(index):
+        while time.time() < stop:
+            call(index)
+            counts[index] += 1
+
+    pool = [threading.Thread(target=client, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return sum(counts) / duration
+
+
+def bench_limiter(threads, duration, clients):
+    limiter = RateLimiter(MemoryStore(), LIMITS, max_active=threads)
+    keys = ["ip:10.0.%d.%d" % (i // 256, i % 256) for i in range(clients)]
+    calls = [0] * threads
+
+    def call(index):
+        calls[index] += 1
+        assert limiter.admit(keys[(index * 7919 + calls[index]) % clients], "GET /order/<int:order_id>") is None
+        limiter.done()
+
+    return run(threads, duration, call)
+
+
+def bench_app(threads, duration, limited):
+    app = inf349.create_app({'RATE_LIMITS': LIMITS if limited else {},
+                             'MAX_ACTIVE_REQUESTS': threads if limited else None})
+    clients = [app.test_client() for _ in range(threads)]
+
+    def call(index):
+        # closing the response gives the concurrency slot back, like a real server does
+        with clients[index].get('/stats') as response:
+            assert response.status_code == 200
+
+    return run(threads, duration, call)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=3)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1000, 100000])
+    args = parser.parse_args()
+
+    for clients in args.clients:
+        rate = bench_limiter(args.threads, args.duration, clients)
+        print("limiter, %d clients: %.0f admit/s, %.2f us per call" % (clients, rate, 1e6 / rate))
+
+    print("%10s %12s" % ("limiter", "requests/s"))
+    for limited in (False, True):
+        print("%10s %12.1f" % ("on" if limited else "off", bench_app(args.threads, args.duration, limited)))
+
+
+if __name__ == "__main__":
+    main()
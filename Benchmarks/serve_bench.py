@@ -0,0 +1,103 @@
+# throughput of GET / and GET /order/<id> for an increasing number of gunicorn workers
+#
+#   python Benchmarks/serve_bench.py --duration 10 --clients 32
+#
+# every run starts serve.py on a fresh port, waits until it answers, then hammers it from a thread pool
+# the server runs in a scratch directory, with a copy of the local catalog snapshot when there is one
+
+import argparse
+import http.client
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/")
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server on port %d did not start" % port)
+
+
+def create_order(port):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.request("POST", "/order", body='{"product": {"id": 1, "quantity": 1}}',
+                 headers={"Content-Type": "application/json"})
+    response = conn.getresponse()
+    response.read()
+    return response.getheader("Location").rsplit("/", 1)[-1]
+
+
+def hammer(port, paths, duration, clients):
+    counts = [0] * clients
+    stop = time.time() + duration
+
+    def client(index):
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        i = 0
+        while time.time() < stop:
+            try:
+                conn.request("GET", paths[i % len(paths)])
+                conn.getresponse().read()
+                counts[index] += 1
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port)
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / duration
+
+
+def run(workers, port, duration, clients, directory):
+    # serve.py opens its database and catalog files in its working directory
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, "serve.py"), "--bind", "127.0.0.1:%d" % port,
+                               "--workers", str(workers)], cwd=directory,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(port)
+        order_id = create_order(port)
+        return hammer(port, ["/", "/order/" + order_id], duration, clients)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--port", type=int, default=5099)
+    args = parser.parse_args()
+
+    cores = multiprocessing.cpu_count()
+    workers = sorted({1, 2, 4, cores, cores * 2} - {0})
+    print("cores: %d" % cores)
+    print("%8s %12s" % ("workers", "req/s"))
+    with tempfile.TemporaryDirectory() as directory:
+        if os.path.exists(os.path.join(ROOT, "catalog.json")):
+            shutil.copy(os.path.join(ROOT, "catalog.json"), directory)
+        for i, count in enumerate(workers):
+            rps = run(count, args.port + i, args.duration, args.clients, directory)
+            print("%8d %12.1f" % (count, rps))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# time for a fresh process to import the app, create it, set up the database and answer its first request
+#
+#   python Benchmarks/startup_bench.py --runs 10
+#
+# every run starts a new interpreter in a scratch directory holding a catalog snapshot, so no network is
+# involved; "cold" runs start with an empty database, "warm" runs reuse the one left by the previous run
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, %(root)r)
+import inf349
+imported = time.perf_counter()
+app = inf349.create_app({'DATABASE': 'bench.db', 'ARCHIVE_DATABASE': 'archive.db',
+                         'CATALOG_SNAPSHOT': 'catalog.json'})
+created = time.perf_counter()
+inf349.setup_db(refresh=False)
+ready = time.perf_counter()
+assert app.test_client().get('/').status_code == 200
+served = time.perf_counter()
+print(imported - start, created - start, ready - start, served - start)
+"""
+
+STEPS = ["import", "create_app", "setup_db", "first request"]
+
+
+def make_snapshot(path, count):
+    types = ["dairy", "vegetable", "fruit", "bakery", "vegan", "meat", "other"]
+    products = [{"id": i, "name": "product %d" % i, "type": types[i % len(types)], "description": "",
+                 "image": "%d.jpg" % i, "height": 10, "weight": 100, "price": 1.5, "in_stock": True}
+                for i in range(1, count + 1)]
+    with open(path, "w") as f:
+        json.dump(products, f)
+
+
+def run(directory):
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", CHILD % {"root": ROOT}], cwd=directory, check=True,
+                            capture_output=True, text=True).stdout
+    total = time.perf_counter() - started
+    return [float(value) for value in output.split()] + [total]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--products", type=int, default=50)
+    args = parser.parse_args()
+
+    print("%6s %14s %10s" % ("", "step", "median ms"))
+    for mode in ("cold", "warm"):
+        timings = []
+        with tempfile.TemporaryDirectory() as directory:
+            make_snapshot(os.path.join(directory, "catalog.json"), args.products)
+            for _ in range(args.runs):
+                if mode == "cold":
+                    for name in ("bench.db", "archive.db"):
+                        if os.path.exists(os.path.join(directory, name)):
+                            os.remove(os.path.join(directory, name))
+                timings.append(run(directory))
+        for i, step in enumerate(STEPS + ["process total"]):
+            print("%6s %14s %10.1f" % (mode, step, statistics.median(t[i] for t in timings) * 1000))
+
+
+if __name__ == "__main__":
+    main()
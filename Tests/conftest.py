@@ -4,20 +4,20 @@
 
 import pytest
 
-from inf349 import app, db, Order, Product, ShippingInfo, Transaction, CreditCard, OrderProduct, populate_database
+from inf349 import create_app, db, MODELS, populate_database
 
 
 @pytest.fixture
 def client():
-    app.config['TESTING'] = True
+    app = create_app({'TESTING': True})
     client = app.test_client()
     # init db
     db.connect()
-    db.create_tables([Product, ShippingInfo, Transaction, CreditCard, Order, OrderProduct])
+    db.create_tables(MODELS)
     populate_database()
     yield client
     # teardown db
-    db.drop_tables([Product, ShippingInfo, Transaction, CreditCard, Order, OrderProduct])
+    db.drop_tables(MODELS)
     db.close()
 
 
@@ -1,3 +1,18 @@
+import asyncio
+import csv
+import datetime
+import gzip
+import io
+import json
+import threading
+import time
+
+import pytest
+
+import inf349
+from inf349 import Product, calculate_shipping_price
+
+
 def create_order(client):
     response = client.post('/order', json={
         'product': {
@@ -8,35 +23,48 @@ def create_order(client):
     assert response.status_code == 302
 
 
+# valid PUT /order/<id> payloads
+SHIPPING_ORDER = {
+    "email": "elon.musk@spacex.com",
+    "shipping_information": {
+        "country": "Senegal",
+        "address": "Rue des potiers",
+        "postal_code": "G7H 0S5",
+        "city": "Chicoutimi",
+        "province": "QC"
+    }
+}
+CREDIT_CARD = {
+    "name": "John Doe",
+    "number": "4242 4242 4242 4242",
+    "expiration_year": 2024,
+    "cvv": "123",
+    "expiration_month": 9
+}
+
+
 def put_valid_shipping_info(client):
-    response = client.put('/order/1', json={
-        "order": {
-            "email": "elon.musk@spacex.com",
-            "shipping_information": {
-                "country": "Senegal",
-                "address": "Rue des potiers",
-                "postal_code": "G7H 0S5",
-                "city": "Chicoutimi",
-                "province": "QC"
-            }
-        }
-    })
+    response = client.put('/order/1', json={"order": SHIPPING_ORDER})
     assert response.status_code == 200
 
 
 def put_valid_credit_card(client):
-    response = client.put('/order/1', json={
-        "credit_card": {
-            "name": "John Doe",
-            "number": "4242 4242 4242 4242",
-            "expiration_year": 2024,
-            "cvv": "123",
-            "expiration_month": 9
-        }
-    })
+    response = client.put('/order/1', json={"credit_card": CREDIT_CARD})
     assert response.status_code == 200
 
 
+def pay_order(client, product_id=1, quantity=10):
+    # creates an order and pays it, returns the paid order document
+    response = client.post('/order', json={'product': {'id': product_id, 'quantity': quantity}})
+    assert response.status_code == 302
+    order_url = response.headers['Location']
+    response = client.put(order_url, json={"order": SHIPPING_ORDER})
+    assert response.status_code == 200
+    response = client.put(order_url, json={"credit_card": CREDIT_CARD})
+    assert response.status_code == 200
+    return response.json["order"]
+
+
 def check_order(client):
     response = client.get('/order/1')
     assert response.status_code == 200
@@ -55,6 +83,71 @@ class TestProducts:
         assert len(response.json) == self.NB_PRODUCTS
 
 
+class TestProductsCompression:
+    NB_PRODUCTS = 50
+
+    def test_gzip(self, client):
+        plain = client.get('/')
+        response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert gzip.decompress(response.data) == plain.data
+
+    def test_identity(self, client):
+        response = client.get('/', headers={'Accept-Encoding': 'gzip;q=0'})
+        assert 'Content-Encoding' not in response.headers
+        assert len(response.json) == self.NB_PRODUCTS
+
+    def test_small_response_not_compressed(self, client):
+        create_order(client)
+        response = client.put('/order/1', json={}, headers={'Accept-Encoding': 'gzip'})
+        assert response.status_code == 422
+        assert 'Content-Encoding' not in response.headers
+
+    def test_stream_ndjson(self, client):
+        response = client.get('/?stream=ndjson')
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        lines = response.data.decode().splitlines()
+        assert [json.loads(line) for line in lines] == client.get('/').json
+
+    def test_stream_json(self, client):
+        response = client.get('/?stream=json')
+        assert response.status_code == 200
+        assert json.loads(response.data) == client.get('/').json
+
+    def test_write_while_streaming(self, client, monkeypatch):
+        monkeypatch.setattr(inf349, "STREAM_BATCH", 10)
+        response = client.get('/?stream=ndjson', buffered=False)
+        chunks = iter(response.response)
+        first = next(chunks)
+        # a slow client in the middle of the catalog, a write from another thread must not wait on it
+        errors = []
+
+        def write():
+            inf349.db.connect(reuse_if_open=True)
+            inf349.db.connection().execute("PRAGMA busy_timeout = 100")
+            try:
+                Product.update(price=Product.price).where(Product.id == 1).execute()
+            except Exception as e:
+                errors.append(e)
+            inf349.db.close()
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        thread.join()
+        assert errors == []
+        lines = (first + b"".join(chunks)).decode().splitlines()
+        response.close()
+        assert [json.loads(line) for line in lines] == client.get('/').json
+
+    def test_stream_gzip(self, client):
+        response = client.get('/?stream=ndjson', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert len(gzip.decompress(response.data).decode().splitlines()) == self.NB_PRODUCTS
+
+
 class TestOrders:
     # Test the POST /order endpoint
 
@@ -455,3 +548,520 @@ class TestGetOrder:
         response = client.get('/order/1')
         assert response.status_code == 200
         check_order(client)
+
+
+class TestProductCache:
+    def cache_stats(self, client):
+        response = client.get('/stats')
+        assert response.status_code == 200
+        return response.json["product_cache"]
+
+    def test_order_paths_share_the_cache(self, client):
+        before = self.cache_stats(client)
+        create_order(client)
+        put_valid_shipping_info(client)
+        put_valid_credit_card(client)
+        check_order(client)
+        after = self.cache_stats(client)
+        # only the first lookup of product 1 misses
+        assert after["misses"] - before["misses"] == 1
+        assert after["hits"] > before["hits"]
+        assert after["size"] == 1
+
+    def test_cleared_by_catalog_writes(self, client):
+        from inf349 import Product, save_products
+
+        create_order(client)
+        assert self.cache_stats(client)["size"] == 1
+        product = Product.select().where(Product.id == 1).dicts().get()
+        save_products([{**product, "price": 99.5}])
+        assert self.cache_stats(client)["size"] == 0
+
+        response = client.get('/order/1')
+        assert response.json["order"]["total_price"] == 99.5 * 10
+
+
+class TestRateLimit:
+    def limit(self, monkeypatch, limits, max_active=None):
+        from ratelimit import MemoryStore, RateLimiter
+
+        limiter = RateLimiter(MemoryStore(), limits, max_active)
+        monkeypatch.setattr(inf349, "rate_limiter", limiter)
+        return limiter
+
+    def test_off_by_default(self, client):
+        from inf349 import rate_limiter
+
+        assert rate_limiter is None
+        for _ in range(20):
+            assert client.get('/stats').status_code == 200
+
+    def test_orders_per_client(self, client, monkeypatch):
+        from inf349 import Order
+
+        self.limit(monkeypatch, {"POST /order": (0.5, 2)})
+        create_order(client)
+        create_order(client)
+        response = client.post('/order', json={'product': {'id': 1, 'quantity': 10}})
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == "2"
+        assert response.json["errors"]["request"]["code"] == "too-many-requests"
+        # rejected before any write
+        assert Order.select().count() == 2
+
+        # clients with a known api key have their own bucket
+        monkeypatch.setattr(inf349, "api_keys", frozenset(["other"]))
+        response = client.post('/order', json={'product': {'id': 1, 'quantity': 10}},
+                               headers={'X-Api-Key': 'other'})
+        assert response.status_code == 302
+        check_order(client)
+
+    def test_unknown_api_keys(self, client, monkeypatch):
+        self.limit(monkeypatch, {"POST /order": (0.5, 1)})
+        monkeypatch.setattr(inf349, "api_keys", frozenset(["known"]))
+        create_order(client)
+        # made up keys count as the client's address
+        for key in ("a", "b", "c"):
+            response = client.post('/order', json={'product': {'id': 1, 'quantity': 10}},
+                                   headers={'X-Api-Key': key})
+            assert response.status_code == 429
+
+    def test_behind_proxy(self, client, monkeypatch):
+        self.limit(monkeypatch, {"POST /order": (0.5, 1)})
+        monkeypatch.setattr(inf349, "trusted_proxies", 1)
+
+        def post(forwarded_for):
+            return client.post('/order', json={'product': {'id': 1, 'quantity': 10}},
+                               headers={'X-Forwarded-For': forwarded_for}).status_code
+
+        # the proxy's address is the same for everyone, the one it forwards tells the clients apart
+        assert post("10.0.0.1") == 302
+        assert post("10.0.0.2") == 302
+        assert post("10.0.0.1") == 429
+        # only the last address comes from the proxy
+        assert post("10.0.0.3, 10.0.0.1") == 429
+
+    def test_polling(self, client, monkeypatch):
+        self.limit(monkeypatch, {"*": (0.1, 3)})
+        create_order(client)
+        # POST /order has its own bucket
+        statuses = [client.get('/order/1').status_code for _ in range(5)]
+        assert statuses == [200, 200, 200, 429, 429]
+
+    def test_busy(self, client, monkeypatch):
+        limiter = self.limit(monkeypatch, {}, max_active=1)
+        # the slot is given back once the server closes the response
+        with client.get('/stats') as response:
+            assert response.status_code == 200
+            assert limiter.concurrency.active == 1
+        assert limiter.concurrency.active == 0
+
+        limiter.concurrency.acquire()
+        response = client.get('/')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == "1"
+        assert response.json["errors"]["request"]["code"] == "server-busy"
+        limiter.done()
+        assert client.get('/').status_code == 200
+
+    def test_busy_while_streaming(self, client, monkeypatch):
+        from werkzeug.test import EnvironBuilder
+
+        create_order(client)
+        limiter = self.limit(monkeypatch, {}, max_active=1)
+        for path in ('/orders?format=csv', '/orders?format=ndjson', '/?stream=json'):
+            body = client.application.wsgi_app(EnvironBuilder(path=path).get_environ(), lambda *args: None)
+            # the body hasn't been produced yet, the slot is still taken
+            assert limiter.concurrency.active == 1
+            assert client.get('/').status_code == 503
+            assert b"".join(body)
+            body.close()
+            assert limiter.concurrency.active == 0
+
+
+class TestListOrders:
+    # Test the GET /orders endpoint
+
+    def create_orders(self, client, count):
+        for _ in range(count):
+            create_order(client)
+
+    def test_list_orders(self, client):
+        self.create_orders(client, 3)
+        response = client.get('/orders')
+        assert response.status_code == 200
+        assert [order["id"] for order in response.json["orders"]] == [1, 2, 3]
+        assert response.json["next"] is None
+        order = response.json["orders"][0]
+        del order["created_at"]
+        assert order == client.get('/order/1').json["order"]
+
+    def test_pagination(self, client):
+        self.create_orders(client, 5)
+        response = client.get('/orders?limit=2')
+        assert [order["id"] for order in response.json["orders"]] == [1, 2]
+        assert response.json["next"] == 2
+        response = client.get('/orders?limit=2&after=4')
+        assert [order["id"] for order in response.json["orders"]] == [5]
+        assert response.json["next"] is None
+
+    def test_filters(self, client):
+        self.create_orders(client, 2)
+        put_valid_shipping_info(client)
+        put_valid_credit_card(client)
+        response = client.get('/orders?paid=true')
+        assert [order["id"] for order in response.json["orders"]] == [1]
+        response = client.get('/orders?paid=false&product=1')
+        assert [order["id"] for order in response.json["orders"]] == [2]
+        response = client.get('/orders?email=elon.musk@spacex.com')
+        assert [order["id"] for order in response.json["orders"]] == [1]
+        response = client.get('/orders?product=2')
+        assert response.json["orders"] == []
+        response = client.get('/orders?from=2000-01-01&to=2000-01-02')
+        assert response.json["orders"] == []
+
+    def test_invalid_filters(self, client):
+        assert client.get('/orders?paid=maybe').status_code == 422
+        assert client.get('/orders?from=yesterday').status_code == 422
+        assert client.get('/orders?limit=0').status_code == 422
+        assert client.get('/orders?after=abc').status_code == 422
+
+    def test_export_ndjson(self, client):
+        self.create_orders(client, 3)
+        response = client.get('/orders?format=ndjson&paid=false')
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        rows = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert rows == client.get('/orders').json["orders"]
+
+    def test_export_csv(self, client):
+        self.create_orders(client, 2)
+        put_valid_shipping_info(client)
+        response = client.get('/orders?format=csv')
+        assert response.status_code == 200
+        assert response.mimetype == 'text/csv'
+        rows = list(csv.DictReader(io.StringIO(response.data.decode())))
+        assert [row["id"] for row in rows] == ["1", "2"]
+        assert rows[0]["city"] == "Chicoutimi"
+        assert rows[1]["city"] == ""
+
+
+class TestReports:
+    # Test the GET /reports/<group> endpoints
+
+    def test_empty(self, client):
+        for group in ("product", "type", "day"):
+            response = client.get('/reports/' + group)
+            assert response.status_code == 200
+            assert response.json["report"] == []
+
+    def test_unpaid_orders_not_counted(self, client):
+        create_order(client)
+        assert client.get('/reports/product').json["report"] == []
+
+    def test_per_product(self, client):
+        first = pay_order(client, 1, 10)
+        second = pay_order(client, 1, 2)
+        report = client.get('/reports/product').json["report"]
+        assert len(report) == 1
+        assert report[0]["product"] == 1
+        assert report[0]["orders"] == 2
+        assert report[0]["quantity"] == 12
+        assert report[0]["revenue"] == pytest.approx(first["total_price"] + second["total_price"])
+        assert report[0]["shipping"] == first["shipping_price"] + second["shipping_price"]
+
+    def test_per_type_and_day(self, client):
+        order = pay_order(client, 1, 10)
+        product = next(product for product in client.get('/').json if product["id"] == 1)
+        report = client.get('/reports/type').json["report"]
+        assert [row["type"] for row in report] == [product["type"]]
+        report = client.get('/reports/day').json["report"]
+        assert report[0]["day"] == datetime.date.today().isoformat()
+        assert report[0]["revenue"] == pytest.approx(order["total_price"])
+
+    def test_date_filters(self, client):
+        pay_order(client, 1, 10)
+        assert client.get('/reports/day?to=2000-01-01').json["report"] == []
+        assert len(client.get('/reports/day?from=2000-01-01').json["report"]) == 1
+        assert client.get('/reports/day?from=tomorrow').status_code == 422
+
+    def test_unknown_group(self, client):
+        assert client.get('/reports/email').status_code == 404
+
+
+class TestQuote:
+    # Test the POST /quote endpoint
+
+    def test_quote_matches_order(self, client):
+        response = client.post('/quote', json={"carts": [{"products": [{"id": 1, "quantity": 10}]}]})
+        assert response.status_code == 200
+        quote = response.json["quotes"][0]
+        create_order(client)
+        order = client.get('/order/1').json["order"]
+        assert quote["total_price"] == order["total_price"]
+        assert quote["shipping_price"] == order["shipping_price"]
+
+    def test_quote_writes_nothing(self, client):
+        client.post('/quote', json={"carts": [{"products": [{"id": 1, "quantity": 10}]}]})
+        assert client.get('/order/1').status_code == 404
+
+    def test_many_carts(self, client):
+        carts = [{"products": [{"id": 1, "quantity": quantity}]} for quantity in range(1, 21)]
+        carts.append({"products": [{"id": 1, "quantity": 1}, {"id": 2, "quantity": 3}]})
+        quotes = client.post('/quote', json={"carts": carts}).json["quotes"]
+        assert len(quotes) == 21
+        products = {product["id"]: product for product in client.get('/').json}
+        for quantity, quote in enumerate(quotes[:20], 1):
+            assert quote["total_price"] == pytest.approx(products[1]["price"] * quantity)
+            assert quote["shipping_price"] == calculate_shipping_price(products[1]["weight"] * quantity)
+        assert quotes[20]["total_price"] == pytest.approx(products[1]["price"] + products[2]["price"] * 3)
+        assert quotes[20]["shipping_price"] == calculate_shipping_price(products[1]["weight"] +
+                                                                        products[2]["weight"] * 3)
+
+    def test_invalid_carts(self, client):
+        quotes = client.post('/quote', json={"carts": [
+            {"products": [{"id": 100, "quantity": 1}]},
+            {"products": [{"id": 1, "quantity": -1}]},
+            {"products": [{"id": 1}]},
+            {"products": []},
+            {"products": [{"id": 1, "quantity": 1}]},
+        ]}).json["quotes"]
+        assert quotes[0]["errors"]["order"]["code"] == "product-does-not-exist"
+        assert quotes[1]["errors"]["order"]["code"] == "invalid-quantity"
+        assert quotes[2]["errors"]["products"]["code"] == "missing-fields"
+        assert quotes[3]["errors"]["products"]["code"] == "missing-fields"
+        assert "errors" not in quotes[4]
+
+    def test_out_of_inventory(self, client):
+        product = next(product for product in client.get('/').json if not product["in_stock"])
+        quotes = client.post('/quote', json={"carts": [{"products": [{"id": product["id"], "quantity": 1}]}]})
+        assert quotes.json["quotes"][0]["errors"]["products"]["code"] == "out-of-inventory"
+
+    def test_invalid_json(self, client):
+        assert client.post('/quote', json='invalid').status_code == 422
+        assert client.post('/quote', json={}).status_code == 422
+        assert client.post('/quote', json={"carts": [{}] * 1001}).status_code == 422
+
+
+class TestAsyncApi:
+    # The asgi.py routes must answer exactly like the flask ones
+
+    @pytest.fixture(autouse=True)
+    def no_catalog_refresh(self, monkeypatch):
+        pytest.importorskip("quart")
+        pytest.importorskip("httpx")
+        import asgi
+
+        monkeypatch.setitem(asgi.app.config, 'CATALOG_REFRESH', False)
+
+    def open(self, method, path, json=None, headers=None, gateway=None):
+        # returns the response with its body read
+        import asgi
+        import httpx
+
+        async def send():
+            async with asgi.app.test_app() as test_app:
+                if gateway:
+                    # stands in for the payment gateway, called with the httpx.Request
+                    await asgi.payment_client.aclose()
+                    asgi.payment_client = httpx.AsyncClient(transport=httpx.MockTransport(gateway))
+                response = await test_app.test_client().open(path, method=method, json=json, headers=headers)
+                response.body = await response.get_data()
+                plain = response.is_json and "Content-Encoding" not in response.headers
+                response.document = await response.get_json() if plain else None
+                return response
+
+        return asyncio.run(send())
+
+    def request(self, method, path, json=None, gateway=None):
+        response = self.open(method, path, json, gateway=gateway)
+        return response.status_code, response.document
+
+    def test_same_as_flask(self, client):
+        create_order(client)
+        pay_order(client)
+        pay_order(client, product_id=2, quantity=3)
+        for method, path, payload in [
+                ("GET", "/", None),
+                ("GET", "/?stream=json", None),
+                ("GET", "/?stream=ndjson", None),
+                ("GET", "/orders", None),
+                ("GET", "/orders?paid=true&limit=1", None),
+                ("GET", "/orders?paid=maybe", None),
+                ("GET", "/orders?limit=0", None),
+                ("GET", "/orders?format=ndjson", None),
+                ("GET", "/orders?format=csv&product=2", None),
+                ("GET", "/reports/product", None),
+                ("GET", "/reports/day?from=2000-01-01", None),
+                ("GET", "/reports/type?to=never", None),
+                ("POST", "/quote", {"carts": [{"products": [{"id": 1, "quantity": 2}]}, {"products": []}]}),
+                ("POST", "/quote", {"carts": []})]:
+            for headers in ({}, {"Accept-Encoding": "gzip"}):
+                expected = client.open(path, method=method, json=payload, headers=headers)
+                response = self.open(method, path, payload, headers=headers)
+                assert response.status_code == expected.status_code, path
+                assert response.headers.get("Content-Encoding") == expected.headers.get("Content-Encoding"), path
+                assert response.mimetype == expected.mimetype, path
+                body, data = response.body, expected.data
+                if headers:
+                    # gzip output depends on how the data was cut in chunks
+                    body = gzip.decompress(body) if response.headers.get("Content-Encoding") else body
+                    data = gzip.decompress(data) if expected.headers.get("Content-Encoding") else data
+                assert body == data, path
+
+    def test_streamed_response_holds_the_slot(self, client, monkeypatch):
+        import asgi
+
+        create_order(client)
+        monkeypatch.setitem(asgi.app.config, 'MAX_ACTIVE_REQUESTS', 1)
+        # released once the body is sent, and only once
+        for path in ("/orders?format=ndjson", "/?stream=json", "/orders?format=csv", "/order/1"):
+            assert self.open("GET", path).status_code == 200
+        assert inf349.rate_limiter.concurrency.active == 0
+
+    def pay(self, request):
+        import httpx
+
+        card = json.loads(request.content)["credit_card"]
+        if card["number"] == "4000 0000 0000 0002":
+            return httpx.Response(422, json={"errors": {"credit_card": {"code": "card-declined",
+                                                                        "name": "La carte a été refusée"}}})
+        return httpx.Response(200, json={"credit_card": card, "transaction": {
+            "id": "a1b2c3", "success": True, "amount_charged": json.loads(request.content)["amount_charged"]}})
+
+    def test_put_credit_card(self, client):
+        create_order(client)
+        put_valid_shipping_info(client)
+        status, body = self.request("PUT", "/order/1", {"credit_card": CREDIT_CARD}, gateway=self.pay)
+        assert status == 200
+        assert body == client.get('/order/1').json
+        assert body["order"]["paid"] is True
+        assert body["order"]["transaction"] == {"id": "a1b2c3", "success": True, "amount_charged": 291.0}
+        assert body["order"]["credit_card"]["last_digits"] == "4242"
+
+    def test_put_credit_card_declined(self, client):
+        create_order(client)
+        put_valid_shipping_info(client)
+        status, body = self.request("PUT", "/order/1", {"credit_card": dict(CREDIT_CARD, number="4000 0000 0000 0002")},
+                                    gateway=self.pay)
+        assert status == 422
+        assert body["errors"]["credit_card"]["code"] == "card-declined"
+        assert client.get('/order/1').json["order"]["paid"] is False
+
+    def test_put_credit_card_gateway_busy(self, client):
+        create_order(client)
+        put_valid_shipping_info(client)
+
+        def busy(request):
+            import httpx
+
+            raise httpx.PoolTimeout("every connection is in use")
+
+        status, body = self.request("PUT", "/order/1", {"credit_card": CREDIT_CARD}, gateway=busy)
+        assert status == 503
+        assert body["errors"]["request"]["code"] == "server-busy"
+        assert client.get('/order/1').json["order"]["paid"] is False
+
+    def test_get_all_products(self, client):
+        status, body = self.request("GET", "/")
+        assert status == 200
+        assert body == client.get('/').json
+
+    def test_create_order(self, client):
+        status, _ = self.request("POST", "/order", {'product': {'id': 1, 'quantity': 10}})
+        assert status == 302
+        check_order(client)
+
+    def test_create_order_invalid_product(self, client):
+        status, body = self.request("POST", "/order", {'product': {'id': 100, 'quantity': 10}})
+        assert status == 404
+        assert body["errors"]["order"]["code"] == "product-does-not-exist"
+
+    def test_put_shipping_info(self, client):
+        create_order(client)
+        status, body = self.request("PUT", "/order/1", {
+            "order": {
+                "email": "elon.musk@spacex.com",
+                "shipping_information": {
+                    "country": "Senegal",
+                    "address": "Rue des potiers",
+                    "postal_code": "G7H 0S5",
+                    "city": "Chicoutimi",
+                    "province": "QC"
+                }
+            }
+        })
+        assert status == 200
+        assert body == client.get('/order/1').json
+
+    def test_get_missing_order(self, client):
+        status, body = self.request("GET", "/order/1")
+        assert status == 404
+        assert body["errors"]["order"]["code"] == "order-does-not-exist"
+
+    def test_concurrent_reads(self, client, monkeypatch):
+        import concurrent.futures
+
+        import asgi
+        from inf349 import db
+
+        create_order(client)
+        queries = []
+        execute_sql = db.execute_sql
+
+        def slow_execute_sql(sql, *args, **kwargs):
+            queries.append(sql)
+            # keep the query in flight long enough for every client to show up
+            time.sleep(0.05)
+            return execute_sql(sql, *args, **kwargs)
+
+        async def send():
+            # waiting reads must not hold threads, two are enough to serve them and a write at the same time
+            asyncio.get_running_loop().set_default_executor(concurrent.futures.ThreadPoolExecutor(2))
+            async with asgi.app.test_app() as test_app:
+                test_client = test_app.test_client()
+                monkeypatch.setattr(db, "execute_sql", slow_execute_sql)
+                responses = await asyncio.gather(
+                    *[test_client.get("/order/1") for _ in range(16)],
+                    test_client.post("/order", json={'product': {'id': 1, 'quantity': 10}}))
+                monkeypatch.setattr(db, "execute_sql", execute_sql)
+                return [response.status_code for response in responses]
+
+        # the order cache starts empty with the server, the 16 misses share one query, none of them waits for
+        # a thread and reads it from the cache later
+        assert asyncio.run(send()) == [200] * 16 + [302]
+        assert len([sql for sql in queries if '"t1"."id" = ?' in sql]) == 1
+
+    def test_rate_limit(self, client, monkeypatch):
+        import asgi
+
+        monkeypatch.setitem(asgi.app.config, 'RATE_LIMITS', {"GET /order/<int:order_id>": (0.1, 1)})
+
+        async def send():
+            async with asgi.app.test_app() as test_app:
+                test_client = test_app.test_client()
+                first = await test_client.get("/order/1")
+                second = await test_client.get("/order/1")
+                return first.status_code, second.status_code, second.headers.get("Retry-After")
+
+        assert asyncio.run(send()) == (404, 429, "10")
+
+    def test_shared_rate_limit_store_off_the_loop(self, client, monkeypatch):
+        import asgi
+        from ratelimit import RateLimiter
+
+        class SharedStore:
+            # stands in for RedisStore, remembers which threads called it
+            threads = []
+
+            def take(self, key, rate, burst):
+                self.threads.append(threading.current_thread())
+                return 0
+
+        async def send():
+            async with asgi.app.test_app() as test_app:
+                monkeypatch.setattr(inf349, "rate_limiter", RateLimiter(SharedStore(), {"*": (1, 1)}))
+                return (await test_app.test_client().get("/order/1")).status_code
+
+        assert asyncio.run(send()) == 404
+        assert SharedStore.threads and threading.main_thread() not in SharedStore.threads
@@ -1,4 +1,22 @@
-from inf349 import db, Order, Product, ShippingInfo, Transaction, CreditCard, OrderProduct, populate_database
+import csv
+import datetime
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from peewee import IntegrityError
+
+import inf349
+from groupcommit import GroupCommitWriter
+from inf349 import db, Order, Product, ShippingInfo, Transaction, CreditCard, OrderProduct, \
+    populate_database, invalidate_catalog, insert_order, close_order_writer, archive_orders, rebuild_rollups, \
+    refresh_catalog, start_catalog_refresh, load_order, load_order_entry, ArchivedOrder
+
+from .functional_test import CREDIT_CARD, SHIPPING_ORDER, pay_order
 
 
 def init_db():
@@ -63,3 +81,459 @@ class TestOrder():
 
 
 
+
+
+class TestConcurrentReads:
+    # Concurrent identical reads must share one computation: the number of queries stays the same however
+    # many clients ask at once
+
+    def count_queries(self, client, monkeypatch, path, concurrency):
+        queries = []
+        execute_sql = db.execute_sql
+
+        def slow_execute_sql(sql, *args, **kwargs):
+            queries.append(sql)
+            # keep the query in flight long enough for every client to show up
+            time.sleep(0.05)
+            return execute_sql(sql, *args, **kwargs)
+
+        monkeypatch.setattr(db, "execute_sql", slow_execute_sql)
+        barrier = threading.Barrier(concurrency)
+        statuses = []
+
+        def read():
+            barrier.wait()
+            statuses.append(client.get(path).status_code)
+
+        threads = [threading.Thread(target=read) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        monkeypatch.setattr(db, "execute_sql", execute_sql)
+
+        assert statuses == [200] * concurrency
+        return len(queries)
+
+    def test_catalog(self, client, monkeypatch):
+        counts = []
+        for concurrency in (1, 8, 32):
+            invalidate_catalog()
+            counts.append(self.count_queries(client, monkeypatch, '/', concurrency))
+        assert counts == [counts[0]] * 3
+
+    def test_order(self, client, monkeypatch):
+        client.post('/order', json={'product': {'id': 1, 'quantity': 10}})
+        counts = []
+        for concurrency in (1, 8, 32):
+            # the misses are what gets coalesced
+            inf349.order_cache.clear()
+            counts.append(self.count_queries(client, monkeypatch, '/order/1', concurrency))
+        assert counts == [1, 1, 1]
+
+
+class TestGroupCommit:
+    # Order creation through the single writer thread
+
+    def test_concurrent_orders(self, client, monkeypatch):
+        monkeypatch.setitem(client.application.config, 'GROUP_COMMIT', True)
+        locations = []
+
+        def create():
+            response = client.post('/order', json={'product': {'id': 1, 'quantity': 2}})
+            assert response.status_code == 302
+            locations.append(response.headers['Location'])
+
+        threads = [threading.Thread(target=create) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        close_order_writer()
+
+        assert len(set(locations)) == 20
+        for location in locations:
+            response = client.get(location)
+            assert response.status_code == 200
+            assert response.json["order"]["product"] == {"id": 1, "quantity": 2}
+
+    def test_failed_write_only_fails_its_caller(self, client):
+        writer = GroupCommitWriter(db, max_wait=0.05)
+        results = {}
+
+        def submit(quantity):
+            try:
+                results[quantity] = writer.submit(insert_order, 1, quantity).id
+            except IntegrityError:
+                results[quantity] = "error"
+
+        # quantity 0 breaks the OrderProduct check constraint
+        threads = [threading.Thread(target=submit, args=(quantity,)) for quantity in (1, 0, 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.close()
+
+        assert results[0] == "error"
+        assert Order.get_by_id(results[1]).id == results[1]
+        assert Order.get_by_id(results[2]).id == results[2]
+        assert OrderProduct.select().count() == 2
+
+
+class TestArchive:
+    # Paid orders moved to the archive database stay readable through GET /order/<id>
+
+    def test_archive(self, client):
+        urls = ['/order/%d' % pay_order(client)["id"] for _ in range(3)]
+        client.post('/order', json={'product': {'id': 1, 'quantity': 10}})
+        documents = [client.get(url).json for url in urls]
+
+        tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
+        assert archive_orders(tomorrow, batch_size=2) == 3
+
+        # only the unpaid order is left in the main tables
+        assert Order.select().count() == 1
+        assert OrderProduct.select().count() == 1
+        assert ShippingInfo.select().count() == 0
+        assert CreditCard.select().count() == 0
+        assert Transaction.select().count() == 0
+        assert [client.get(url).json for url in urls] == documents
+
+    def test_listed(self, client):
+        for _ in range(3):
+            pay_order(client)
+        client.post('/order', json={'product': {'id': 2, 'quantity': 1}})
+        listed = client.get('/orders').json["orders"]
+        export = client.get('/orders?format=ndjson').data
+        queries = ['/orders?paid=true', '/orders?paid=false', '/orders?product=1', '/orders?product=2',
+                   '/orders?email=elon.musk@spacex.com', '/orders?from=2000-01-01', '/orders?to=2000-01-01',
+                   '/orders?limit=2&after=1']
+        filtered = [client.get(query).json for query in queries]
+
+        archive_orders(datetime.datetime.now() + datetime.timedelta(days=1))
+        assert ArchivedOrder.select().count() == 3
+        assert client.get('/orders').json["orders"] == listed
+        assert client.get('/orders?format=ndjson').data == export
+        assert [client.get(query).json for query in queries] == filtered
+        assert [row["id"] for row in csv.DictReader(io.StringIO(client.get('/orders?format=csv').data.decode()))] \
+            == ["1", "2", "3", "4"]
+
+    def test_cutoff(self, client):
+        pay_order(client)
+        client.post('/order', json={'product': {'id': 1, 'quantity': 10}})
+        assert archive_orders(datetime.datetime.now() - datetime.timedelta(days=1)) == 0
+        assert Order.select().count() == 2
+
+    def test_last_order_is_kept(self, client):
+        # sqlite would give its id to the next order
+        pay_order(client)
+        tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
+        assert archive_orders(tomorrow) == 0
+
+    def test_put_archived_order(self, client):
+        url = '/order/%d' % pay_order(client)["id"]
+        client.post('/order', json={'product': {'id': 1, 'quantity': 10}})
+        archive_orders(datetime.datetime.now() + datetime.timedelta(days=1))
+        response = client.put(url, json={"order": {}})
+        assert response.status_code == 422
+        assert response.json["errors"]["order"]["code"] == "order-archived"
+
+    def test_rollups_keep_archived_orders(self, client):
+        pay_order(client)
+        pay_order(client)
+        report = client.get('/reports/product').json
+        archive_orders(datetime.datetime.now() + datetime.timedelta(days=1))
+        rebuild_rollups()
+        assert client.get('/reports/product').json == report
+
+    def test_rollups_count_the_payment_day(self, client):
+        # an order created a few days before it was paid, in the hot tables then in the archive
+        pay_order(client)
+        pay_order(client)
+        Order.update(created_at=datetime.datetime.now() - datetime.timedelta(days=3)).execute()
+        report = client.get('/reports/day').json
+        assert [row["day"] for row in report["report"]] == [datetime.date.today().isoformat()]
+        rebuild_rollups()
+        assert client.get('/reports/day').json == report
+        archive_orders(datetime.datetime.now())
+        rebuild_rollups()
+        assert client.get('/reports/day').json == report
+
+
+class TestCatalogSnapshot:
+    # The catalog is loaded from the local snapshot, the remote one is only fetched when there is none
+
+    PRODUCTS = [
+        {"id": 1, "name": "Brocoli", "type": "vegetable", "description": "vert", "image": "1.jpg", "height": 10,
+         "weight": 400, "price": 2.5, "in_stock": True},
+        {"id": 2, "name": "Pain", "type": "bakery", "description": "blanc", "image": "2.jpg", "height": 20,
+         "weight": 600, "price": 4.0, "in_stock": False},
+    ]
+
+    def use_snapshot(self, monkeypatch, tmp_path, products):
+        path = tmp_path / "catalog.json"
+        if products is not None:
+            path.write_text(json.dumps(products))
+        monkeypatch.setattr(inf349, "catalog_snapshot", str(path))
+        Product.delete().execute()
+        return path
+
+    def test_populate_from_snapshot(self, client, monkeypatch, tmp_path):
+        self.use_snapshot(monkeypatch, tmp_path, self.PRODUCTS)
+
+        def no_network():
+            raise AssertionError("the catalog must come from the snapshot")
+
+        monkeypatch.setattr(inf349, "fetch_catalog", no_network)
+        assert populate_database() is True
+        assert client.get('/').json == self.PRODUCTS
+
+    def test_populate_writes_snapshot(self, client, monkeypatch, tmp_path):
+        path = self.use_snapshot(monkeypatch, tmp_path, None)
+        monkeypatch.setattr(inf349, "fetch_catalog", lambda: self.PRODUCTS)
+        assert populate_database() is False
+        assert json.loads(path.read_text()) == self.PRODUCTS
+        assert Product.select().count() == 2
+
+    def test_refresh(self, client, monkeypatch, tmp_path):
+        path = self.use_snapshot(monkeypatch, tmp_path, self.PRODUCTS)
+        populate_database()
+        assert client.get('/').json == self.PRODUCTS
+
+        refreshed = [dict(self.PRODUCTS[0], price=3.0), self.PRODUCTS[1]]
+        monkeypatch.setattr(inf349, "fetch_catalog", lambda: refreshed)
+        start_catalog_refresh().join()
+        assert json.loads(path.read_text()) == refreshed
+        assert client.get('/').json == refreshed
+
+    def test_refresh_on_every_start(self, client, monkeypatch, tmp_path):
+        self.use_snapshot(monkeypatch, tmp_path, self.PRODUCTS)
+        fetched = []
+        monkeypatch.setattr(inf349, "fetch_catalog", lambda: fetched.append(1) or self.PRODUCTS)
+        # the first start fills the products from the snapshot, the next ones find them in the database
+        for _ in range(2):
+            inf349.setup_db().join()
+        assert len(fetched) == 2
+        assert inf349.setup_db(refresh=False) is None
+        assert len(fetched) == 2
+
+    def test_refresh_removed_product(self, client, monkeypatch, tmp_path):
+        self.use_snapshot(monkeypatch, tmp_path, self.PRODUCTS)
+        populate_database()
+        client.post('/order', json={'product': {'id': 1, 'quantity': 1}})
+
+        monkeypatch.setattr(inf349, "fetch_catalog", lambda: [self.PRODUCTS[1]])
+        refresh_catalog()
+        # still there for the existing orders, but out of stock
+        assert client.get('/').json == [dict(self.PRODUCTS[0], in_stock=False), self.PRODUCTS[1]]
+        assert client.get('/order/1').status_code == 200
+        response = client.post('/order', json={'product': {'id': 1, 'quantity': 1}})
+        assert response.status_code == 422
+        assert response.json["errors"]["products"]["code"] == "out-of-inventory"
+
+    def test_refreshed_by_another_process(self, client, monkeypatch, tmp_path):
+        path = self.use_snapshot(monkeypatch, tmp_path, self.PRODUCTS)
+        populate_database()
+        monkeypatch.setattr(inf349, "CATALOG_CHECK_INTERVAL", 0)
+        assert client.get('/').json == self.PRODUCTS
+
+        for refresh, price in enumerate((3.0, 4.0), 1):
+            # what refresh_catalog() does in the other process, without touching this one's catalog
+            products = [dict(self.PRODUCTS[0], price=price), self.PRODUCTS[1]]
+            Product.update(price=price).where(Product.id == 1).execute()
+            inf349.build_catalog_store()
+            inf349.save_catalog_snapshot(products)
+            mtime = path.stat().st_mtime_ns + refresh * 10 ** 9
+            os.utime(path, ns=(mtime, mtime))
+
+            # only lookups in between, the json catalog isn't rebuilt until the end
+            assert inf349.get_product(1)["price"] == price
+        assert client.get('/').json == products
+
+    def test_empty_catalog_opened_once(self, client, monkeypatch, tmp_path):
+        self.use_snapshot(monkeypatch, tmp_path, [])
+        populate_database()
+        opened = []
+        open_catalog_store = inf349.open_catalog_store
+        monkeypatch.setattr(inf349, "open_catalog_store", lambda: opened.append(1) or open_catalog_store())
+        assert len(inf349.get_catalog_store()) == 0
+        assert inf349.get_catalog_store() is inf349.get_catalog_store()
+        assert len(opened) == 1
+
+    def test_failed_refresh_keeps_catalog(self, client, monkeypatch, tmp_path):
+        self.use_snapshot(monkeypatch, tmp_path, self.PRODUCTS)
+        populate_database()
+
+        def offline():
+            raise OSError("offline")
+
+        monkeypatch.setattr(inf349, "fetch_catalog", offline)
+        refresh_catalog()
+        assert client.get('/').json == self.PRODUCTS
+
+
+class TestOrderCache:
+    # After every PUT branch, GET /order/<id> (served from the cache) must match the database
+
+    def create(self, client):
+        response = client.post('/order', json={'product': {'id': 1, 'quantity': 10}})
+        assert response.status_code == 302
+        return int(response.headers['Location'].rsplit('/', 1)[-1])
+
+    def check(self, client, order_id=1):
+        entry = inf349.order_cache.get(order_id)
+        assert entry is not None
+        assert entry == load_order_entry(order_id)
+        assert client.get('/order/%d' % order_id).json["order"] == load_order(order_id)
+        return entry[1]
+
+    def put(self, client, payload, status, order_id=1):
+        # read first so a stale document would be in the cache
+        client.get('/order/%d' % order_id)
+        response = client.put('/order/%d' % order_id, json=payload)
+        assert response.status_code == status
+        if status == 200:
+            assert response.json["order"] == load_order(order_id)
+        return self.check(client, order_id)
+
+    def test_creation(self, client):
+        self.create(client)
+        # written through, the redirected GET doesn't query the order
+        assert inf349.order_cache.get(1) == load_order_entry(1)
+        self.check(client)
+
+    def test_shipping(self, client):
+        self.create(client)
+        assert self.put(client, {"order": SHIPPING_ORDER}, 200)["email"] == "elon.musk@spacex.com"
+
+        moved = {"email": "eddy.malou@congo.cd",
+                 "shipping_information": dict(SHIPPING_ORDER["shipping_information"], city="Kinshasa")}
+        assert self.put(client, {"order": moved}, 200)["shipping_info"]["city"] == "Kinshasa"
+
+    def test_shipping_update_only_touches_its_order(self, client):
+        self.create(client)
+        self.create(client)
+        self.put(client, {"order": SHIPPING_ORDER}, 200, order_id=1)
+        self.put(client, {"order": SHIPPING_ORDER}, 200, order_id=2)
+        moved = {"email": "eddy.malou@congo.cd",
+                 "shipping_information": dict(SHIPPING_ORDER["shipping_information"], city="Kinshasa")}
+        self.put(client, {"order": moved}, 200, order_id=2)
+        assert self.check(client, order_id=1)["shipping_info"]["city"] == "Chicoutimi"
+
+    def test_shipping_errors(self, client):
+        self.create(client)
+        self.put(client, {"order": {"email": "elon.musk@spacex.com"}}, 422)
+        self.put(client, {"order": dict(SHIPPING_ORDER, shipping_information={
+            **SHIPPING_ORDER["shipping_information"], "postal_code": None})}, 422)
+        self.put(client, {"order": dict(SHIPPING_ORDER, email="not an email")}, 422)
+        self.put(client, {"order": SHIPPING_ORDER}, 200)
+
+        # the shipping info is written before the email fails, the document must show it
+        moved = {"email": "not an email",
+                 "shipping_information": dict(SHIPPING_ORDER["shipping_information"], city="Kinshasa")}
+        cached = self.put(client, {"order": moved}, 422)
+        assert cached["shipping_info"]["city"] == "Kinshasa"
+        assert cached["email"] == "elon.musk@spacex.com"
+
+    def test_payment(self, client):
+        self.create(client)
+        # refused before reaching the gateway
+        self.put(client, {"credit_card": CREDIT_CARD}, 422)
+        self.put(client, {"order": SHIPPING_ORDER}, 200)
+        self.put(client, {"credit_card": {"name": "Eddy Malou"}}, 422)
+        self.put(client, {"credit_card": dict(CREDIT_CARD, number="1234 1234 1234 1234")}, 422)
+        # declined by the gateway
+        assert self.put(client, {"credit_card": dict(CREDIT_CARD, number="4000 0000 0000 0002")}, 422)["paid"] is False
+
+        cached = self.put(client, {"credit_card": CREDIT_CARD}, 200)
+        assert cached["paid"] is True
+        assert cached["credit_card"]["last_digits"] == "4242"
+        assert cached["transaction"]
+
+        self.put(client, {"credit_card": CREDIT_CARD}, 422)
+
+    def test_payment_recorded_but_card_invalid(self, client):
+        self.create(client)
+        self.put(client, {"order": SHIPPING_ORDER}, 200)
+        # the transaction is committed before the card is refused
+        cached = self.put(client, {"credit_card": dict(CREDIT_CARD, expiration_month=13)}, 400)
+        assert cached["paid"] is True
+        assert cached["credit_card"] == {}
+
+    def test_invalid_payloads(self, client):
+        self.create(client)
+        self.put(client, {"something": "else"}, 422)
+        client.get('/order/1')
+        response = client.put('/order/1', data="{", content_type='application/json')
+        assert response.status_code in (400, 422)
+        self.check(client)
+
+    def test_missing_order(self, client):
+        response = client.put('/order/1', json={"order": SHIPPING_ORDER})
+        assert response.status_code == 404
+        assert inf349.order_cache.get(1) is None
+
+    def test_catalog_writes(self, client):
+        self.create(client)
+        self.check(client)
+        product = Product.select().where(Product.id == 1).dicts().get()
+        inf349.save_products([{**product, "price": 1.5}])
+        assert client.get('/order/1').json["order"]["total_price"] == 15.0
+
+    def test_stale_read_is_caught(self, client):
+        self.create(client)
+        stale = load_order_entry(1)
+        self.put(client, {"order": SHIPPING_ORDER}, 200)
+        # a read that loaded the order before the write finishes after it
+        inf349.order_cache.set(1, stale)
+        assert client.get('/order/1').json["order"]["email"] == "elon.musk@spacex.com"
+        self.check(client)
+
+    def test_stale_instance_saved(self, client):
+        self.create(client)
+        self.put(client, {"order": SHIPPING_ORDER}, 200)
+        # checkout reads the order, then waits on the payment gateway
+        order = Order.get_by_id(1)
+        moved = dict(SHIPPING_ORDER, email="eddy.malou@congo.cd")
+        self.put(client, {"order": moved}, 200)
+        # another worker caches the unpaid document in between
+        other_worker = load_order_entry(1)
+
+        assert inf349.record_payment(order, CREDIT_CARD, {"id": "stale", "success": True,
+                                                          "amount_charged": 291}) is None
+        inf349.refresh_order(1)
+        inf349.order_cache.set(1, other_worker)
+        cached = client.get('/order/1').json["order"]
+        assert cached["paid"] is True
+        assert cached["email"] == "eddy.malou@congo.cd"
+        self.check(client)
+
+    def put_from_another_process(self, payload, status=200):
+        # a second worker on the same database, with its own order cache
+        code = ("import json, sys\n"
+                "sys.path.insert(0, %r)\n"
+                "import inf349\n"
+                "client = inf349.create_app({'TESTING': True}).test_client()\n"
+                "print(client.put('/order/1', json=json.loads(sys.argv[1])).status_code)\n"
+                % os.path.dirname(os.path.abspath(inf349.__file__)))
+        result = subprocess.run([sys.executable, "-c", code, json.dumps(payload)], cwd=os.getcwd(), check=True,
+                                capture_output=True, text=True)
+        assert int(result.stdout.split()[-1]) == status
+
+    def test_writes_from_another_process(self, client):
+        self.create(client)
+        assert client.get('/order/1').json["order"]["email"] is None
+
+        self.put_from_another_process({"order": SHIPPING_ORDER})
+        assert client.get('/order/1').json["order"]["email"] == "elon.musk@spacex.com"
+
+        moved = {"email": "eddy.malou@congo.cd",
+                 "shipping_information": dict(SHIPPING_ORDER["shipping_information"], city="Kinshasa")}
+        self.put_from_another_process({"order": moved})
+        assert client.get('/order/1').json["order"]["shipping_info"]["city"] == "Kinshasa"
+        # and the failed write that still changed the shipping info
+        self.put_from_another_process({"order": dict(moved, email="not an email", shipping_information=dict(
+            moved["shipping_information"], city="Lubumbashi"))}, status=422)
+        assert client.get('/order/1').json["order"]["shipping_info"]["city"] == "Lubumbashi"
+        self.check(client)
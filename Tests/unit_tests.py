@@ -1,4 +1,17 @@
-from inf349 import calculate_shipping_price, Order, Product, CreditCard, Transaction, ShippingInfo
+import asyncio
+import gzip
+import os
+import threading
+
+import pytest
+
+import catalog_store
+import compression
+from cache import LRUCache
+from ratelimit import MemoryStore, RateLimiter, retry_after
+from singleflight import AsyncSingleFlight, SingleFlight
+from inf349 import calculate_shipping_price, calculate_shipping_prices, cart_totals, Order, Product, CreditCard, \
+    Transaction, ShippingInfo
 
 
 class TestOrder():
@@ -10,6 +23,15 @@ class TestOrder():
         assert calculate_shipping_price(2000) == 25
         assert calculate_shipping_price(5000) == 25
 
+    def test_shipping_prices(self):
+        weights = [20, 0, 500, 1555, 2000, 5000]
+        assert calculate_shipping_prices(weights) == [calculate_shipping_price(weight) for weight in weights]
+        assert calculate_shipping_prices([]) == []
+
+    def test_cart_totals(self):
+        assert cart_totals([(10.0, 100, 2)]) == (20.0, 5)
+        assert cart_totals([(10.0, 100, 2), (1.5, 1000, 2)]) == (23.0, 25)
+
     def test_create_order(self, client):
         # create order
         order = Order(id=1, email="test@gmail.com")
@@ -91,3 +113,266 @@ class TestCreditCard():
         # create credit card
         credit_card = CreditCard(id=1)
         assert str(credit_card) == "1"
+
+
+class TestCompression():
+
+    def test_negotiate(self):
+        assert compression.negotiate("gzip, deflate") == "gzip"
+        assert compression.negotiate("deflate") is None
+        assert compression.negotiate("gzip;q=0") is None
+        assert compression.negotiate("*") == compression.supported_encodings()[0]
+        assert compression.negotiate(None) is None
+
+    def test_compress_stream(self):
+        chunks = [b"a" * 100, b"b" * 100]
+        assert gzip.decompress(b"".join(compression.compress_stream(iter(chunks), "gzip"))) == b"".join(chunks)
+        assert b"".join(compression.compress_stream(iter(chunks), None)) == b"".join(chunks)
+
+
+class TestSingleFlight():
+
+    def test_do(self):
+        flight = SingleFlight()
+        assert flight.do("key", lambda x: x * 2, 21) == 42
+        # nothing is kept once the call is over
+        assert flight.do("key", lambda x: x * 3, 21) == 63
+
+    def test_error(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise ValueError
+
+        try:
+            flight.do("key", fail)
+            assert False
+        except ValueError:
+            pass
+        assert flight.do("key", lambda: 1) == 1
+
+    def test_async(self):
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def load(x):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            return x * 2
+
+        async def main():
+            return await asyncio.gather(*[flight.do("key", load, 21) for _ in range(10)])
+
+        assert asyncio.run(main()) == [42] * 10
+        assert calls == [21]
+
+    def test_async_error_and_cancel(self):
+        flight = AsyncSingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError
+
+        async def main():
+            results = await asyncio.gather(flight.do("key", fail), flight.do("key", fail), return_exceptions=True)
+            assert [type(result) for result in results] == [ValueError, ValueError]
+
+            # the first caller goes away, the second still gets the result
+            first = asyncio.ensure_future(flight.do("key", asyncio.sleep, 0.01, 1))
+            second = asyncio.ensure_future(flight.do("key", asyncio.sleep, 0.01, 2))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await second
+
+        assert asyncio.run(main()) == 1
+
+
+class TestLRUCache():
+
+    def test_get_or_load(self):
+        cache = LRUCache(maxsize=2)
+        loads = []
+
+        def load(key):
+            loads.append(key)
+            return key * 2 if key else None
+
+        assert cache.get_or_load(1, load) == 2
+        assert cache.get_or_load(1, load) == 2
+        # missing values aren't cached
+        assert cache.get_or_load(0, load) is None
+        assert cache.get_or_load(0, load) is None
+        assert loads == [1, 0, 0]
+        assert cache.stats() == {"size": 1, "maxsize": 2, "hits": 1, "misses": 3, "evictions": 0}
+
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        # "b" is the least recently used
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        assert cache.stats()["evictions"] == 1
+
+    def test_ttl(self, monkeypatch):
+        now = [100.0]
+        monkeypatch.setattr("cache.time.monotonic", lambda: now[0])
+        cache = LRUCache(ttl=10)
+        cache.set("a", 1)
+        now[0] += 9
+        assert cache.get("a") == 1
+        now[0] += 1
+        assert cache.get("a") is None
+        assert cache.stats()["size"] == 0
+
+    def test_add(self, monkeypatch):
+        now = [100.0]
+        monkeypatch.setattr("cache.time.monotonic", lambda: now[0])
+        cache = LRUCache(ttl=10)
+        assert cache.add("a", 1) is True
+        assert cache.add("a", 2) is False
+        assert cache.get("a") == 1
+        # an expired entry counts as missing
+        now[0] += 10
+        assert cache.add("a", 3) is True
+        assert cache.get("a") == 3
+
+    def test_delete_and_clear(self):
+        cache = LRUCache()
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.delete("a")
+        cache.delete("missing")
+        assert cache.get("a") is None
+        cache.clear()
+        assert cache.get("b") is None
+
+
+class TestRateLimiter():
+
+    def store(self):
+        now = [100.0]
+        return MemoryStore(clock=lambda: now[0]), now
+
+    def test_token_bucket(self):
+        store, now = self.store()
+        # a burst of 3, then one every half second
+        assert [store.take("a", 2, 3) for _ in range(3)] == [0, 0, 0]
+        assert store.take("a", 2, 3) == 0.5
+        # other keys have their own bucket
+        assert store.take("b", 2, 3) == 0
+        now[0] += 0.5
+        assert store.take("a", 2, 3) == 0
+        assert store.take("a", 2, 3) > 0
+        # never more than the burst
+        now[0] += 60
+        assert [store.take("a", 2, 3) for _ in range(4)][-1] > 0
+
+    def test_prune(self):
+        store, now = self.store()
+        store.max_keys = 2
+        store.take("a", 1, 1)
+        now[0] += 2
+        store.take("b", 1, 1)
+        store.take("c", 1, 1)
+        # "a" refilled, it is dropped, the others are still counting
+        assert sorted(store._buckets) == ["b", "c"]
+        assert store.take("b", 1, 1) > 0
+
+    def test_prune_least_recently_used(self):
+        store, now = self.store()
+        store.max_keys = 2
+        store.take("a", 1, 1)
+        store.take("b", 1, 1)
+        store.take("a", 1, 1)
+        store.take("c", 1, 1)
+        assert sorted(store._buckets) == ["a", "c"]
+        assert store.take("a", 1, 1) > 0
+        # many more clients than max_keys, the store doesn't grow past it
+        for i in range(100):
+            store.take("ip:%d" % i, 1, 1)
+        assert len(store._buckets) == 2
+
+    def test_routes(self):
+        store, _ = self.store()
+        limiter = RateLimiter(store, {"POST /order": (1, 1), "*": (1, 2)})
+        assert limiter.admit("ip:1", "POST /order") is None
+        assert limiter.admit("ip:1", "POST /order") == (429, 1)
+        assert limiter.admit("ip:2", "POST /order") is None
+        # the default limit, counted per route
+        assert limiter.admit("ip:1", "GET /") is None
+        assert limiter.admit("ip:1", "GET /") is None
+        assert limiter.admit("ip:1", "GET /") == (429, 1)
+        assert limiter.admit("ip:1", "GET /orders") is None
+        assert RateLimiter(store, {}).admit("ip:1", "GET /") is None
+
+    def test_concurrency(self):
+        limiter = RateLimiter(MemoryStore(), {}, max_active=2)
+        assert limiter.admit("ip:1", "GET /") is None
+        assert limiter.admit("ip:2", "GET /") is None
+        assert limiter.admit("ip:3", "GET /") == (503, 1)
+        limiter.done()
+        assert limiter.admit("ip:3", "GET /") is None
+
+    def test_retry_after(self):
+        assert retry_after(0.01) == 1
+        assert retry_after(1) == 1
+        assert retry_after(1.2) == 2
+
+
+class TestColumnarCatalog():
+    ROWS = [
+        (2, "Brocoli", "vegetable", "vert", "2.jpg", 10, 400, 2.5, True),
+        (5, "Pain", "bakery", "blanc", "5.jpg", 20, 600, 4.0, False),
+        (9, "Crème", "dairy", "", "9.jpg", 5, 250, 3.25, True),
+    ]
+
+    def open(self, tmp_path, rows):
+        path = str(tmp_path / "catalog.bin")
+        catalog_store.write_catalog(path, rows)
+        return catalog_store.ColumnarCatalog(path)
+
+    def test_lookup(self, tmp_path):
+        catalog = self.open(tmp_path, self.ROWS)
+        assert len(catalog) == 3
+        assert catalog.get(5) == dict(zip(catalog_store.FIELDS, self.ROWS[1]))
+        assert catalog.get(9)["name"] == "Crème"
+        assert catalog.get("2")["id"] == 2
+        assert catalog.get(3) is None
+        assert catalog.get(100) is None
+        assert catalog.get(None) is None
+        assert catalog.get(True) is None
+        catalog.close()
+
+    def test_iterate(self, tmp_path):
+        catalog = self.open(tmp_path, self.ROWS)
+        assert list(catalog) == [dict(zip(catalog_store.FIELDS, row)) for row in self.ROWS]
+        catalog.close()
+
+    def test_empty(self, tmp_path):
+        catalog = self.open(tmp_path, [])
+        assert len(catalog) == 0
+        assert list(catalog) == []
+        assert catalog.get(1) is None
+        catalog.close()
+
+    def test_concurrent_writers(self, tmp_path):
+        path = str(tmp_path / "catalog.bin")
+        threads = [threading.Thread(target=catalog_store.write_catalog, args=(path, self.ROWS)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        catalog = catalog_store.ColumnarCatalog(path)
+        assert list(catalog) == [dict(zip(catalog_store.FIELDS, row)) for row in self.ROWS]
+        catalog.close()
+        # no temporary file left behind
+        assert os.listdir(tmp_path) == ["catalog.bin"]
+
+    def test_unsorted(self, tmp_path):
+        with pytest.raises(ValueError):
+            self.open(tmp_path, [self.ROWS[1], self.ROWS[0]])
+
@@ -0,0 +1,264 @@
+# async version of the api, for checkouts that spend most of their time waiting on the payment gateway
+#
+#   hypercorn asgi:app --workers 2
+#
+# same routes, same responses and errors as inf349.py: the order logic is shared, peewee calls (streamed
+# bodies included) run in worker threads and the payment request goes through an async http client, so a
+# waiting checkout only costs a coroutine instead of a whole thread
+
+import asyncio
+import json
+
+import httpx
+from quart import Quart, g, request, redirect, url_for, jsonify
+from quart.wrappers.response import DataBody
+
+import compression
+import errors
+import inf349
+import ratelimit
+from inf349 import Order
+from singleflight import AsyncSingleFlight
+
+app = Quart(__name__)
+
+# shared http client, opened when the server starts
+payment_client = None
+# checkouts talking to the gateway at once per worker, the ones above wait up to PAYMENT_POOL_TIMEOUT seconds
+# for a connection and then get a 503
+PAYMENT_MAX_CONNECTIONS = 1000
+PAYMENT_POOL_TIMEOUT = 5
+
+
+@app.before_serving
+async def open_payment_client():
+    global payment_client
+    config = {**inf349.DEFAULT_CONFIG, **app.config}
+    inf349.configure(config)
+    # each worker runs it, so each worker refreshes the catalog
+    await db_call(inf349.setup_db, config['CATALOG_REFRESH'])
+    payment_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(30, pool=PAYMENT_POOL_TIMEOUT),
+        limits=httpx.Limits(max_connections=PAYMENT_MAX_CONNECTIONS, max_keepalive_connections=100))
+
+
+@app.after_serving
+async def close_payment_client():
+    await payment_client.aclose()
+
+
+def db_call(fn, *args):
+    # peewee is blocking, run it in the default thread pool
+    return asyncio.to_thread(fn, *args)
+
+
+# the flask routes' SingleFlight would have every waiting request block a thread of the pool, and a burst of
+# identical reads would hold up every other db_call
+reads = AsyncSingleFlight()
+
+
+def shared_read(key, fn, *args):
+    # concurrent identical reads run fn once in the pool, the others wait as coroutines
+    return reads.do(key, db_call, fn, *args)
+
+
+@app.before_request
+async def limit_request():
+    # unknown urls are left to the 404
+    limiter = inf349.rate_limiter
+    if limiter is None or request.url_rule is None:
+        return None
+    args = (limiter, request.method + " " + request.url_rule.rule,
+            inf349.request_client(request.headers, request.remote_addr))
+    if isinstance(limiter.store, ratelimit.MemoryStore):
+        # a dict lookup under a lock, cheaper inline than a thread hop
+        error = inf349.rejected_request(*args)
+    else:
+        # a shared store is a blocking network call, it must not hold up the event loop
+        error = await db_call(inf349.rejected_request, *args)
+    if error:
+        return error
+    g.rate_limiter = limiter
+
+
+@app.teardown_request
+async def release_request(exc):
+    limiter = g.pop('rate_limiter', None)
+    if limiter:
+        limiter.done()
+
+
+@app.after_request
+async def compress_response(response):
+    # compression.compress_response for quart's responses, streamed ones are compressed by streamed()
+    if response.status_code != 200 or "Content-Encoding" in response.headers:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+    if encoding is None or not isinstance(response.response, DataBody):
+        return response
+    data = await response.get_data()
+    if len(data) >= compression.MIN_SIZE:
+        response.set_data(compression.compress(data, encoding))
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def streamed(chunks, mimetype):
+    # a response sending a generator of bytes, quart runs each step in the thread pool. The rate limiter's
+    # slot is held until the whole body is sent, like inf349.hold_request does
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+    limiter = g.pop('rate_limiter', None)
+    response = app.response_class(held(compression.compress_stream(chunks, encoding), limiter), mimetype=mimetype)
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def held(chunks, limiter):
+    try:
+        yield from chunks
+    finally:
+        if limiter:
+            limiter.done()
+
+
+@app.route('/', methods=['GET'])
+async def display_products():
+    stream = request.args.get('stream')
+    if stream in ('json', 'ndjson'):
+        return streamed(inf349.stream_catalog(stream),
+                        'application/x-ndjson' if stream == 'ndjson' else 'application/json')
+
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+    response = app.response_class(await shared_read(("catalog", encoding), inf349.get_catalog, encoding),
+                                  mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+@app.route('/stats', methods=['GET'])
+async def stats():
+    return jsonify({"product_cache": inf349.product_cache.stats(), "order_cache": inf349.order_cache.stats()})
+
+
+@app.route('/orders', methods=['GET'])
+async def list_orders():
+    where, error = inf349.filter_orders(request.args)
+    if error:
+        return error
+
+    export = request.args.get('format')
+    if export in inf349.EXPORT_MIMETYPES:
+        return streamed(inf349.export_orders(where, export), inf349.EXPORT_MIMETYPES[export])
+
+    page, error = await db_call(inf349.orders_page, where, request.args)
+    if error:
+        return error
+    return jsonify(page)
+
+
+@app.route('/quote', methods=['POST'])
+async def quote():
+    try:
+        carts = (await request.get_json()).get('carts')
+    except AttributeError:
+        return errors.error_handler("quote", "json-not-valid", "Le json n\'est pas au bon format"), 422
+
+    error = inf349.check_carts(carts)
+    if error:
+        return error
+    return jsonify({"quotes": await db_call(inf349.quote_carts, carts)})
+
+
+@app.route('/reports/<any(product, type, day):group>', methods=['GET'])
+async def reports(group):
+    rows, error = await db_call(inf349.sales_report, group, request.args)
+    if error:
+        return error
+    return jsonify({"report": rows})
+
+
+@app.route('/order', methods=['POST'])
+async def post_order():
+    try:
+        payload = (await request.get_json()).get('product')
+    except AttributeError:
+        return errors.error_handler("order", "json-not-valid", "Le json n\'est pas au bon format"), 422
+
+    new_order, error = await db_call(inf349.create_order, payload)
+    if error:
+        return error
+
+    # redirect to order/<id> page after creation
+    return redirect(url_for('order_id_handler', order_id=new_order.id))
+
+
+@app.route('/order/<int:order_id>', methods=['GET', 'PUT'])
+async def order_id_handler(order_id):
+    async def get_order():
+        order_dict = await shared_read(("order", order_id), inf349.cached_order, order_id)
+
+        # Check if order exists
+        if not order_dict:
+            return errors.error_handler("order", "order-does-not-exist", "L'order n'existe pas"), 404
+
+        return jsonify({"order": order_dict})
+
+    async def put_order():
+
+        async def written(error):
+            # same as inf349: the document is rebuilt after any write, failed ones included
+            order_dict = await db_call(inf349.refresh_order, order_id)
+            return error or jsonify({"order": order_dict})
+
+        async def update_shipping_order(data):
+            return await written(await db_call(inf349.update_shipping_order, order, data))
+
+        async def update_credit_card(data):
+            pay_payload, error = await db_call(inf349.prepare_payment, order, data)
+            if error:
+                return error
+
+            # Send payment request, the worker is free to serve other requests while the gateway answers
+            try:
+                response = await payment_client.post(inf349.PAYMENT_URL, json=pay_payload)
+            except httpx.PoolTimeout:
+                # nothing was sent, the client can try again
+                return errors.error_handler("request", "server-busy", "Le serveur est occupé, réessayez plus tard"), \
+                    503, {"Retry-After": "1"}
+
+            if response.status_code != 200:
+                return response.json(), response.status_code
+
+            return await written(await db_call(inf349.record_payment, order, data, response.json()["transaction"]))
+
+        # Check if order exists
+        order = await db_call(Order.get_or_none, Order.id == order_id)
+
+        if not order:
+            return await db_call(inf349.missing_order_error, order_id)
+
+        try:
+            # Check payload
+            payload = await request.get_json()
+            if "order" in payload:
+                return await update_shipping_order(payload["order"])
+            elif "credit_card" in payload:
+                return await update_credit_card(payload["credit_card"])
+            else:
+                return errors.error_handler("order", "missing-fields", "Il manque des champs dans le json"), 422
+        except (json.JSONDecodeError, ValueError):
+            return errors.error_handler("order", "json-not-valid", "Le json n'est pas au bon format"), 422
+
+    if request.method == 'GET':
+        return await get_order()
+    elif request.method == 'PUT':
+        try:
+            return await put_order()
+        finally:
+            # GETs arriving from now on must see this write
+            reads.forget(("order", order_id))
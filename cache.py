@@ -0,0 +1,150 @@
+# caches with the same interface kept in the process or in redis
+#
+#   products = LRUCache(maxsize=1024, ttl=300)
+#   products.get_or_load(1, load_product)
+#   orders = create_cache("redis://localhost:6379/0", maxsize=10000, ttl=60, prefix="order:")
+#
+# entries are dropped after ttl seconds, and the least recently used one when maxsize is reached.
+# set() overwrites, add() only stores when the key is missing: fill a cache after a read with add() and
+# after a write with set(), a read that started before the write then can't put back its older value.
+# RedisCache (pip install redis) is shared by every worker, values go through json and maxsize is left to
+# redis' own eviction policy.
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._store(key, value, expires)
+
+    def add(self, key, value):
+        # returns False when the key was already there
+        now = time.monotonic()
+        expires = now + self.ttl if self.ttl is not None else None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                return False
+            self._store(key, value, expires)
+            return True
+
+    def _store(self, key, value, expires):
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_load(self, key, load):
+        # read-through, None results aren't cached
+        value = self.get(key)
+        if value is None:
+            value = load(key)
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class RedisCache:
+    def __init__(self, url, ttl=None, prefix=""):
+        if redis is None:
+            raise RuntimeError("RedisCache needs the redis package")
+        self.ttl = ttl
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+        # counted by this process only
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return self.prefix + str(key)
+
+    def get(self, key, default=None):
+        value = self._redis.get(self._key(key))
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        self._redis.set(self._key(key), json.dumps(value), ex=self.ttl)
+
+    def add(self, key, value):
+        return bool(self._redis.set(self._key(key), json.dumps(value), ex=self.ttl, nx=True))
+
+    def get_or_load(self, key, load):
+        value = self.get(key)
+        if value is None:
+            value = load(key)
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def delete(self, key):
+        self._redis.delete(self._key(key))
+
+    def clear(self):
+        # only the keys under this cache's prefix
+        for key in self._redis.scan_iter(match=self.prefix + "*"):
+            self._redis.delete(key)
+
+    def stats(self):
+        return {"size": None, "maxsize": None, "hits": self.hits, "misses": self.misses, "evictions": None}
+
+
+def create_cache(url=None, maxsize=1024, ttl=None, prefix=""):
+    # shared through redis when there is a url, in the process otherwise
+    if url:
+        return RedisCache(url, ttl=ttl, prefix=prefix)
+    return LRUCache(maxsize=maxsize, ttl=ttl)
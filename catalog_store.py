@@ -0,0 +1,160 @@
+# compact, read-only product catalog stored column by column in a single file
+#
+#   write_catalog("catalog.bin", rows)      # rows are tuples in FIELDS order, sorted by id
+#   catalog = ColumnarCatalog("catalog.bin")
+#   catalog.get(1)                          # {"id": 1, "name": ..., "price": ...} or None
+#
+# numbers live in flat typed columns, each string field in one utf-8 blob cut by an offsets column and the
+# product types, which repeat a lot, as a one byte code into a small table. The file is memory-mapped, so
+# the pages are shared by every process mapping it (forked workers included) instead of each one holding
+# its own copy.
+# Lookups by id are a binary search over the sorted id column, there is no per-process index to build.
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+FIELDS = ("id", "name", "type", "description", "image", "height", "weight", "price", "in_stock")
+
+# section name -> array typecode
+NUMERIC = {"id": "q", "height": "q", "weight": "q", "price": "d", "in_stock": "B", "type": "B"}
+STRINGS = ("name", "description", "image")
+
+# the file starts with the length of a json header describing the sections that follow it
+_HEADER_LENGTH = struct.Struct("<Q")
+
+
+def write_catalog(path, rows):
+    columns = {name: array(code) for name, code in NUMERIC.items()}
+    offsets = {name: array("Q", [0]) for name in STRINGS}
+    blobs = {name: bytearray() for name in STRINGS}
+    types = {}
+
+    last_id = None
+    for row in rows:
+        product = dict(zip(FIELDS, row))
+        if last_id is not None and product["id"] <= last_id:
+            raise ValueError("rows must be sorted by id")
+        last_id = product["id"]
+
+        for name in ("id", "height", "weight", "price"):
+            columns[name].append(product[name])
+        columns["in_stock"].append(1 if product["in_stock"] else 0)
+        columns["type"].append(types.setdefault(product["type"], len(types)))
+        for name in STRINGS:
+            blobs[name] += (product[name] or "").encode()
+            offsets[name].append(len(blobs[name]))
+
+    sections = [(name, columns[name].tobytes(), NUMERIC[name]) for name in NUMERIC]
+    for name in STRINGS:
+        sections.append((name + "_offsets", offsets[name].tobytes(), "Q"))
+        sections.append((name + "_strings", bytes(blobs[name]), "B"))
+
+    # section offsets are relative to the end of the header, aligned for the typed views
+    header = {"count": len(columns["id"]), "types": list(types), "sections": {}}
+    position = 0
+    for name, data, code in sections:
+        header["sections"][name] = [position, len(data), code]
+        position = _align(position + len(data))
+    encoded = json.dumps(header).encode()
+    start = _align(_HEADER_LENGTH.size + len(encoded))
+
+    # a temporary file of its own, several processes may be writing the catalog at the same time
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + ".",
+                               suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_HEADER_LENGTH.pack(len(encoded)))
+            f.write(encoded)
+            for name, data, _ in sections:
+                f.seek(start + header["sections"][name][0])
+                f.write(data)
+            # the file must hold at least one byte to be mapped
+            f.seek(max(start + position, start + 1) - 1)
+            f.write(b"\0")
+        # renamed over the old file, processes that still map it keep reading the old version
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def product_key(product_id):
+    # the id as an int, or None if it can't be a product id
+    if isinstance(product_id, str) and product_id.isdigit():
+        # sqlite would have matched "1" with 1 too
+        product_id = int(product_id)
+    if isinstance(product_id, bool) or not isinstance(product_id, int):
+        return None
+    return product_id
+
+
+def _align(position):
+    return (position + 7) // 8 * 8
+
+
+class ColumnarCatalog:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        length, = _HEADER_LENGTH.unpack_from(self._map)
+        header = json.loads(self._map[_HEADER_LENGTH.size:_HEADER_LENGTH.size + length])
+        start = _align(_HEADER_LENGTH.size + length)
+
+        self.count = header["count"]
+        self.types = [sys.intern(name) for name in header["types"]]
+        self._view = memoryview(self._map)
+        self._columns = []
+        for name, (offset, size, code) in header["sections"].items():
+            column = self._view[start + offset:start + offset + size].cast(code)
+            self._columns.append(column)
+            setattr(self, name, column)
+
+    def __len__(self):
+        return self.count
+
+    def row(self, product_id):
+        # row of the product, or None
+        product_id = product_key(product_id)
+        if product_id is None:
+            return None
+        row = bisect.bisect_left(self.id, product_id)
+        if row < self.count and self.id[row] == product_id:
+            return row
+        return None
+
+    def get(self, product_id):
+        row = self.row(product_id)
+        return None if row is None else self.product(row)
+
+    def product(self, row):
+        return {
+            "id": self.id[row],
+            "name": self._string("name", row),
+            "type": self.types[self.type[row]],
+            "description": self._string("description", row),
+            "image": self._string("image", row),
+            "height": self.height[row],
+            "weight": self.weight[row],
+            "price": self.price[row],
+            "in_stock": bool(self.in_stock[row]),
+        }
+
+    def __iter__(self):
+        for row in range(self.count):
+            yield self.product(row)
+
+    def _string(self, name, row):
+        offsets = getattr(self, name + "_offsets")
+        return bytes(getattr(self, name + "_strings")[offsets[row]:offsets[row + 1]]).decode()
+
+    def close(self):
+        for column in self._columns:
+            column.release()
+        self._view.release()
+        self._map.close()
@@ -0,0 +1,77 @@
+# group commit: writes from many threads are handed to a single writer thread that runs them in batches,
+# one transaction (and one fsync) per batch instead of one per write
+#
+#   writer = GroupCommitWriter(db)
+#   order = writer.submit(insert_order, product_id, quantity)
+#
+# each write runs in its own savepoint, so a failing write only rolls back itself and its caller gets the
+# exception back, the others in the batch still commit. submit() returns once the batch is committed.
+
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class GroupCommitWriter:
+    def __init__(self, database, max_batch=64, max_wait=0.002):
+        self.database = database
+        self.max_batch = max_batch
+        # how long the writer waits for more writes before committing a batch that isn't full
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._queue.put((fn, args, future))
+        return future.result()
+
+    def close(self):
+        # commits what is already queued then stops the writer thread
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=self.max_wait)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+            if stop:
+                break
+        self.database.close()
+
+    def _commit(self, batch):
+        results = []
+        try:
+            with self.database.atomic():
+                for fn, args, future in batch:
+                    try:
+                        with self.database.atomic():
+                            results.append((future, fn(*args), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+        except Exception as e:
+            # the commit itself failed, nothing from this batch was written
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        # only answer once the batch is committed, so callers never see a row that could still be rolled back
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
@@ -1,15 +1,101 @@
+import bisect
+import csv
+import datetime
+import io
 import json
+import os
+import tempfile
+import threading
+import time
 
+import click
 import peewee
-import requests
-from flask import Flask, request, redirect, url_for, jsonify
-from playhouse.shortcuts import dict_to_model, model_to_dict
+from flask import Blueprint, Flask, current_app, g, request, redirect, url_for, jsonify
 
+import catalog_store
+import compression
 import errors
-
-app = Flask(__name__)
-
-db = peewee.SqliteDatabase('lmao.db')
+import ratelimit
+from cache import LRUCache, create_cache
+from groupcommit import GroupCommitWriter
+from singleflight import SingleFlight
+
+# requests and playhouse.shortcuts are imported where they are used, importing this module or creating the
+# app must stay fast and never touch the network
+
+DEFAULT_CONFIG = {
+    'DATABASE': 'lmao.db',
+    # old paid orders, moved out of the main tables by archive_orders()
+    'ARCHIVE_DATABASE': 'lmao_archive.db',
+    # local copy of the remote catalog, the database is filled from it without any network call
+    'CATALOG_SNAPSHOT': 'catalog.json',
+    # columnar copy of the products, memory-mapped by every worker, see catalog_store.py
+    'CATALOG_STORE': 'catalog.bin',
+    # fetch the remote catalog in the background when asgi.py starts, see setup_db
+    'CATALOG_REFRESH': True,
+    # queue order creations to a single writer thread that commits them in batches, see groupcommit.py
+    'GROUP_COMMIT': False,
+    # token buckets, "METHOD rule" (e.g. "POST /order") or "*" -> (requests per second, burst), see ratelimit.py
+    'RATE_LIMITS': {},
+    # redis url for buckets shared by every worker, without it each process keeps its own
+    'RATE_LIMIT_STORE': None,
+    # requests a process serves at once, the ones above get a 503
+    'MAX_ACTIVE_REQUESTS': None,
+    # api keys clients may send in X-Api-Key to get their own buckets, any other key counts as no key
+    'API_KEYS': (),
+    # reverse proxies in front of the app: the client address is then the one the first proxy added to
+    # X-Forwarded-For, without it every client behind the proxy shares the proxy's bucket. Only set it when
+    # the app can't be reached without going through them, the header is easy to forge otherwise
+    'TRUSTED_PROXIES': 0,
+    # rendered order documents by id, see cache.py. Each process keeps its own and checks the order's version
+    # on every hit, a redis url shares them between workers instead
+    'ORDER_CACHE_SIZE': 10000,
+    'ORDER_CACHE_TTL': 60,
+    'ORDER_CACHE_URL': None,
+}
+
+api = Blueprint('api', __name__, cli_group=None)
+
+# opened by configure()
+db = peewee.SqliteDatabase(None)
+
+CATALOG_URL = "http://dimprojetu.uqac.ca/~jgnault/shops/products/"
+PAYMENT_URL = "http://dimprojetu.uqac.ca/~jgnault/shops/pay/"
+
+catalog_snapshot = DEFAULT_CONFIG['CATALOG_SNAPSHOT']
+catalog_store_path = DEFAULT_CONFIG['CATALOG_STORE']
+# None when nothing is limited
+rate_limiter = None
+api_keys = frozenset()
+trusted_proxies = 0
+# [version, document] of the orders, updated by every write to an order (see refresh_order)
+order_cache = LRUCache(maxsize=DEFAULT_CONFIG['ORDER_CACHE_SIZE'], ttl=DEFAULT_CONFIG['ORDER_CACHE_TTL'])
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.update(config or {})
+    configure(app.config)
+    app.register_blueprint(api)
+    return app
+
+
+def configure(config):
+    # points the models at the configured files, nothing is opened until the first query
+    global catalog_snapshot, catalog_store_path, rate_limiter, api_keys, trusted_proxies, order_cache
+    if db.deferred or db.database != config['DATABASE']:
+        db.init(config['DATABASE'])
+    # attached to every connection so archived orders can be moved in the same transaction
+    db.detach('archive')
+    db.attach(config['ARCHIVE_DATABASE'], 'archive')
+    catalog_snapshot = config['CATALOG_SNAPSHOT']
+    catalog_store_path = config['CATALOG_STORE']
+    rate_limiter = ratelimit.create_limiter(config)
+    api_keys = frozenset(config['API_KEYS'])
+    trusted_proxies = config['TRUSTED_PROXIES']
+    order_cache = create_cache(config['ORDER_CACHE_URL'], config['ORDER_CACHE_SIZE'], config['ORDER_CACHE_TTL'],
+                               prefix="order:")
 
 
 class BaseModel(peewee.Model):
@@ -62,10 +148,17 @@ class Order(BaseModel):
     id = peewee.IntegerField(primary_key=True, unique=True)
     shipping_info = peewee.ForeignKeyField(ShippingInfo, backref='shipping_info', null=True)
     product = peewee.ForeignKeyField(Product, backref='product')
-    email = peewee.CharField(max_length=255, constraints=[peewee.Check('email LIKE "%@%.%"')], null=True)
+    email = peewee.CharField(max_length=255, constraints=[peewee.Check('email LIKE "%@%.%"')], null=True,
+                             index=True)
     paid = peewee.BooleanField(null=False, default=False)
     credit_card = peewee.ForeignKeyField(CreditCard, backref='credit_card', null=True)
     transaction = peewee.ForeignKeyField(Transaction, backref='transaction', null=True)
+    created_at = peewee.DateTimeField(null=False, default=datetime.datetime.now, index=True)
+    # the day the sales rollups count the order on
+    paid_at = peewee.DateTimeField(null=True)
+    # bumped after every write, tells the workers their cached document is outdated (see cached_order)
+    # only refresh_order() writes it, saves must leave it out
+    version = peewee.IntegerField(null=False, default=0)
 
 
 # m2m table
@@ -75,207 +168,287 @@ class OrderProduct(BaseModel):
     quantity = peewee.IntegerField(null=False, constraints=[peewee.Check('quantity >= 1')])
 
 
-@app.route('/', methods=['GET'])
-def display_products():
-    products = Product.select()
-    return jsonify([model_to_dict(product) for product in products])
+# sales per product and per day, kept up to date when an order is paid so reports never scan the orders
+class SalesRollup(BaseModel):
+    day = peewee.DateField(null=False)
+    product = peewee.ForeignKeyField(Product, backref='sales')
+    type = peewee.CharField(max_length=255, null=False)
+    orders = peewee.IntegerField(null=False, default=0)
+    quantity = peewee.IntegerField(null=False, default=0)
+    revenue = peewee.FloatField(null=False, default=0)
+    shipping = peewee.FloatField(null=False, default=0)
 
+    class Meta:
+        primary_key = peewee.CompositeKey('day', 'product')
 
-@app.route('/order', methods=['POST'])
-def post_order():
-    try:
-        payload = request.json.get('product')
-    except AttributeError:
-        return errors.error_handler("order", "json-not-valid", "Le json n\'est pas au bon format"), 422
 
-    if not payload:
-        return errors.error_handler("products", "missing-fields",
-                                    "La création d'une commande nécessite un produit"), 422
+# a paid order moved to the archive database, stored as its final document since it can't change anymore
+class ArchivedOrder(BaseModel):
+    id = peewee.IntegerField(primary_key=True)
+    created_at = peewee.DateTimeField(null=False, index=True)
+    paid_at = peewee.DateTimeField(null=True)
+    document = peewee.TextField(null=False)
 
-    product_id = payload.get('id')
-    quantity = payload.get('quantity')
+    class Meta:
+        schema = 'archive'
+        table_name = 'archived_order'
 
-    if not product_id or not quantity:
-        return errors.error_handler("products", "missing-fields",
-                                    "La création d'une commande nécessite un produit et une quantité"), 422
 
-    # check if product exists
-    product = Product.get_or_none(Product.id == product_id)
-    if not product:
-        return errors.error_handler("order", "product-does-not-exist", "Le produit n'existe pas"), 404
+MODELS = [Product, ShippingInfo, Transaction, CreditCard, Order, OrderProduct, SalesRollup, ArchivedOrder]
 
-    # check if product is in stock
-    if not product.in_stock:
-        return errors.error_handler("products", "out-of-inventory", "Le produit demandé n'est pas en inventaire"), 422
+# serialized catalog, built once by warm_catalog() and shared by every request (and every forked worker)
+# keyed by content encoding, None being the uncompressed json
+_catalog = {}
+# the products for lookups, opened by get_catalog_store()
+_catalog_store = None
+# snapshot file version when the store was opened, the catalog is built from that store
+# checked every CATALOG_CHECK_INTERVAL seconds
+_catalog_version = None
+_catalog_checked = 0
+CATALOG_CHECK_INTERVAL = 5
 
-    # check if quantity is valid
-    if quantity < 1:
-        return errors.error_handler("order", "invalid-quantity", "La quantité ne peut pas être inférieure à 1"), 422
+_order_writer = None
+_order_writer_lock = threading.Lock()
 
-    # create order
-    try:
-        new_order = Order.create(product_id=product_id)
-        OrderProduct.create(order_id=new_order.id, product_id=product_id, quantity=quantity)
-    except peewee.IntegrityError as e:
-        print(e)
-        return errors.error_handler("order", "invalid-fields", "Les champs sont mal remplis"), 422
+# products by id for the order paths, emptied with the catalog
+PRODUCT_CACHE_SIZE = 1024
+PRODUCT_CACHE_TTL = 300
+product_cache = LRUCache(maxsize=PRODUCT_CACHE_SIZE, ttl=PRODUCT_CACHE_TTL)
 
-    # redirect to order/<id> page after creation
-    return redirect(url_for('order_id_handler', order_id=new_order.id))
+# coalesces concurrent identical reads (catalog build, GET /order/<id>) into one database query
+reads = SingleFlight()
 
+# rows per chunk when streaming the catalog
+STREAM_BATCH = 100
 
-@app.route('/order/<int:order_id>', methods=['GET', 'PUT'])
-def order_id_handler(order_id):
-    def get_order():
-        # Check if order exists
-        order = Order.get_or_none(Order.id == order_id)
-        if not order:
-            return errors.error_handler("order", "order-does-not-exist", "L'order n'existe pas"), 404
 
-        # Get order info
-        order_dict = model_to_dict(order)
+@api.before_request
+def limit_request():
+    # runs before the view, a rejected request costs no database work
+    if rate_limiter is None:
+        return None
+    error = rejected_request(rate_limiter, request.method + " " + request.url_rule.rule,
+                             request_client(request.headers, request.remote_addr))
+    if error:
+        return error
+    g.rate_limiter = rate_limiter
 
-        # Get product info from order.product_id
-        order_product = OrderProduct.get(OrderProduct.order_id == order.id)
 
-        # Add product info to order
-        order_dict["product"] = {
-            "id": order_product.product.id,
-            "quantity": order_product.quantity
-        }
+@api.after_request
+def hold_request(response):
+    # streamed bodies (/orders exports, ?stream=) are produced after the view returns, the slot is only
+    # given back once the server closes the response
+    limiter = g.pop('rate_limiter', None)
+    if limiter:
+        response.call_on_close(limiter.done)
+    return response
 
-        # Add total price to order
-        order_dict["total_price"] = order_product.product.price * order_product.quantity
 
-        # Shipping price is calculated from product weight and quantity
-        weight = order_product.quantity * order_product.product.weight
+@api.teardown_request
+def release_request(exc):
+    # the view failed, there is no response to wait for
+    limiter = g.pop('rate_limiter', None)
+    if limiter:
+        limiter.done()
 
-        order_dict["shipping_price"] = calculate_shipping_price(weight)
 
-        # Get shipping info from order.shipping_info_id
-        shipping_info = {}
-        if order.shipping_info:
-            shipping_info = model_to_dict(ShippingInfo.get_or_none(order.shipping_info))
-            # no need to send id to client
-            del shipping_info["id"]
+@api.route('/', methods=['GET'])
+def display_products():
+    stream = request.args.get('stream')
+    if stream in ('json', 'ndjson'):
+        mimetype = 'application/x-ndjson' if stream == 'ndjson' else 'application/json'
+        # compressed on the fly by the after_request hook
+        return current_app.response_class(stream_catalog(stream), mimetype=mimetype)
+
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+    response = current_app.response_class(get_catalog(encoding), mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+@api.after_app_request
+def compress_response(response):
+    return compression.compress_response(response, request.headers.get('Accept-Encoding'))
+
+
+def get_catalog(encoding=None):
+    check_catalog_version()
+    catalog = _catalog or reads.do("catalog", warm_catalog)
+    if encoding not in catalog:
+        catalog[encoding] = compression.compress(catalog[None], encoding)
+    return catalog[encoding]
+
+
+def get_catalog_store():
+    check_catalog_version()
+    # an empty catalog is falsy
+    if _catalog_store is not None:
+        return _catalog_store
+    return reads.do("catalog-store", open_catalog_store)
+
+
+def open_catalog_store():
+    global _catalog_store, _catalog_version
+    # read before opening: if the store is replaced in between, the next check sees a newer snapshot and
+    # opens it again
+    _catalog_version = snapshot_version()
+    if not os.path.exists(catalog_store_path):
+        build_catalog_store()
+    _catalog_store = catalog_store.ColumnarCatalog(catalog_store_path)
+    return _catalog_store
+
+
+def build_catalog_store():
+    fields = [getattr(Product, name) for name in catalog_store.FIELDS]
+    catalog_store.write_catalog(catalog_store_path,
+                                Product.select(*fields).order_by(Product.id).tuples().iterator())
+
+
+def warm_catalog():
+    global _catalog
+    products = list(get_catalog_store())
+    data = json.dumps(products, sort_keys=True).encode()
+    # precompress once, requests then only pick the right bytes
+    catalog = {None: data}
+    for encoding in compression.supported_encodings():
+        catalog[encoding] = compression.compress(data, encoding)
+    _catalog = catalog
+    return catalog
+
+
+def invalidate_catalog():
+    # mapped stores aren't closed, requests may still be reading them, they go away with their last reference
+    global _catalog, _catalog_store
+    _catalog = {}
+    _catalog_store = None
+    product_cache.clear()
+    # order totals are computed from the current prices
+    order_cache.clear()
+
+
+def get_product(product_id):
+    # the product as a dict, or None if it doesn't exist
+    product_id = catalog_store.product_key(product_id)
+    if product_id is None:
+        return None
+    check_catalog_version()
+    return product_cache.get_or_load(product_id, load_product)
+
+
+def load_product(product_id):
+    return get_catalog_store().get(product_id)
+
+
+def check_catalog_version():
+    # the products may have been refreshed by another process (see refresh_catalog), which rewrites the
+    # snapshot once it is done
+    global _catalog_checked
+    now = time.monotonic()
+    if now - _catalog_checked < CATALOG_CHECK_INTERVAL:
+        return
+    _catalog_checked = now
+    if (_catalog or _catalog_store is not None) and snapshot_version() != _catalog_version:
+        invalidate_catalog()
+
+
+def snapshot_version():
+    try:
+        return os.stat(catalog_snapshot).st_mtime_ns
+    except FileNotFoundError:
+        return None
 
-        order_dict["shipping_info"] = shipping_info
 
-        # Get credit card from order.credit_card_id
-        credit_card = {}
-        if order.credit_card:
-            credit_card = model_to_dict(CreditCard.get_or_none(order.credit_card))
-            # no need to send id to client
-            del credit_card["id"]
+def stream_catalog(stream):
+    # yields the catalog as json or ndjson, STREAM_BATCH rows at a time, without loading the whole table
+    # one query per batch: a cursor left open between yields would hold sqlite's read lock for as long as the
+    # client takes to read, and writers would fail with "database is locked"
+    if stream == 'json':
+        yield b'['
+    after = 0
+    while True:
+        rows = product_page(after)
+        if not rows:
+            break
+        yield catalog_chunk(rows, stream, first=after == 0)
+        after = rows[-1]["id"]
+    if stream == 'json':
+        yield b']'
 
-        order_dict["credit_card"] = credit_card
 
-        # Get transaction from order.transaction_id
-        transaction = {}
-        if order.transaction:
-            transaction = model_to_dict(Transaction.get_or_none(Transaction.id == order.transaction.id))
+def product_page(after):
+    # the STREAM_BATCH products following the id `after`
+    return list(Product.select().where(Product.id > after).order_by(Product.id).limit(STREAM_BATCH).dicts())
 
-        order_dict["transaction"] = transaction
 
-        return jsonify({"order": order_dict})
+def catalog_chunk(rows, stream, first):
+    lines = [json.dumps(row, sort_keys=True) for row in rows]
+    if stream == 'ndjson':
+        return ''.join(line + '\n' for line in lines).encode()
+    return (('' if first else ',') + ','.join(lines)).encode()
 
-    def put_order():
 
-        def update_shipping_order(data):
-            if not all(key in data for key in ("shipping_information", "email")):
-                raise ValueError
-            shipping_info = data["shipping_information"]
-            if not all(key in shipping_info for key in ("address", "city", "province", "postal_code", "country")):
-                raise ValueError
+@api.route('/order', methods=['POST'])
+def post_order():
+    try:
+        payload = request.json.get('product')
+    except AttributeError:
+        return errors.error_handler("order", "json-not-valid", "Le json n\'est pas au bon format"), 422
 
-                # Check if shipping info exists
-            if order.shipping_info:
-                # Update shipping info instance
-                shipping_info_instance = ShippingInfo.get_or_none(ShippingInfo.id == order.shipping_info.id)
-                shipping_info_instance.update(**shipping_info).execute()
-            else:
-                # Create new shipping info instance
-                try:
-                    shipping_info_instance = ShippingInfo.create(**shipping_info)
-                    order.shipping_info = shipping_info_instance
-                except peewee.IntegrityError:
-                    return errors.error_handler("orders", "invalid-fields",
-                                                "Les informations d'achat ne sont pas correctes"), 422
-
-            # Update order email and save
-            order.email = data["email"]
-            try:
-                order.save()
-            except peewee.IntegrityError:
-                return errors.error_handler("orders", "invalid-fields",
-                                            "Les informations d'achat ne sont pas correctes"), 422
-
-            return get_order()
+    new_order, error = create_order(payload, current_app.config['GROUP_COMMIT'])
+    if error:
+        return error
+
+    # redirect to order/<id> page after creation
+    return redirect(url_for('.order_id_handler', order_id=new_order.id))
 
-        def update_credit_card(data):
-            if order.paid:
-                return errors.error_handler("order", "already-paid", "La commande a deja ete payé"), 422
 
-            if not all(key in data for key in ("name", "number", "expiration_year", "cvv", "expiration_month")):
-                return errors.error_handler("credit-card", "missing-fields", "Il manque des champs dans le json"), 422
+@api.route('/order/<int:order_id>', methods=['GET', 'PUT'])
+def order_id_handler(order_id):
+    def get_order():
+        # concurrent GETs of this order missing the cache run a single query
+        order_dict = reads.do(("order", order_id), cached_order, order_id)
+
+        # Check if order exists
+        if not order_dict:
+            return errors.error_handler("order", "order-does-not-exist", "L'order n'existe pas"), 404
 
-            if order.email is None or order.shipping_info is None:
-                return errors.error_handler("order", "missing-fields",
-                                            "Les informations du client sont nécessaire avant"
-                                            " d'appliquer une carte de crédit"), 422
+        return jsonify({"order": order_dict})
 
-            if not (data["number"] == "4000 0000 0000 0002" or data["number"] == "4242 4242 4242 4242"):
-                return errors.error_handler("credit-card", "incorrect-number", "Le numéro de carte est invalide"), 422
+    def put_order():
 
-            order_product = OrderProduct.get_or_none(OrderProduct.order == order)
+        def written(error):
+            # the order may have changed even when the update failed half way, its document is rebuilt either way
+            order_dict = refresh_order(order_id)
+            return error or jsonify({"order": order_dict})
 
-            if not order_product:
-                return errors.error_handler("order", "unknown-error", "contactez l'administrateur du site"), 418  # :)
-                # please don't remove this
+        def update_credit_card(data):
+            pay_payload, error = prepare_payment(order, data)
+            if error:
+                return error
 
-            pay_payload = {
-                "credit_card": {**data},
-                "amount_charged": order_product.product.price * order_product.quantity + calculate_shipping_price(
-                    order_product.product.weight * order_product.quantity),
-            }
+            import requests
 
             # Send payment request
-            response = requests.post("http://dimprojetu.uqac.ca/~jgnault/shops/pay/", json=pay_payload)
-
-            if response.status_code == 200:
-                # Create transaction
-                transaction = Transaction.create(**response.json()["transaction"])
-                order.transaction = transaction
-                order.paid = True
-                order.save()
-            else:
-                return response.json(), response.status_code
+            response = requests.post(PAYMENT_URL, json=pay_payload)
 
-                # add credit card to order
-            try:
-                credit_card = CreditCard.create(name=data["name"], first_digits=data["number"][:4],
-                                                last_digits=data["number"][-4:],
-                                                expiration_year=data["expiration_year"],
-                                                expiration_month=data["expiration_month"])
-                order.credit_card = credit_card
-                order.save()
-            except peewee.IntegrityError:
-                return errors.error_handler("credit-card", "invalid-fields",
-                                            "Les informations de la carte de crédit ne sont pas correctes"), 400
+            if response.status_code != 200:
+                return response.json(), response.status_code
 
-            return get_order()
+            return written(record_payment(order, data, response.json()["transaction"]))
 
         # Check if order exists
         order = Order.get_or_none(Order.id == order_id)
 
         if not order:
-            return errors.error_handler("order", "order-not-found", "L'order n'existe pas"), 404
+            return missing_order_error(order_id)
 
         try:
             # Check payload
             payload = request.json
             if "order" in payload:
-                return update_shipping_order(payload["order"])
+                return written(update_shipping_order(order, payload["order"]))
             elif "credit_card" in payload:
                 return update_credit_card(payload["credit_card"])
             else:
@@ -286,48 +459,825 @@ def order_id_handler(order_id):
     if request.method == 'GET':
         return get_order()
     elif request.method == 'PUT':
-        return put_order()
+        try:
+            return put_order()
+        finally:
+            # GETs arriving from now on must see this write
+            reads.forget(("order", order_id))
 
 
-def calculate_shipping_price(weight):
-    if weight < 500:
-        return 5
-    elif weight < 2000:
-        return 10
+@api.route('/orders', methods=['GET'])
+def list_orders():
+    where, error = filter_orders(request.args)
+    if error:
+        return error
+
+    export = request.args.get('format')
+    if export in EXPORT_MIMETYPES:
+        return current_app.response_class(export_orders(where, export), mimetype=EXPORT_MIMETYPES[export])
+
+    page, error = orders_page(where, request.args)
+    if error:
+        return error
+    return jsonify(page)
+
+
+@api.route('/quote', methods=['POST'])
+def quote():
+    try:
+        carts = request.json.get('carts')
+    except AttributeError:
+        return errors.error_handler("quote", "json-not-valid", "Le json n\'est pas au bon format"), 422
+
+    error = check_carts(carts)
+    if error:
+        return error
+    return jsonify({"quotes": quote_carts(carts)})
+
+
+REPORT_GROUPS = {
+    'product': SalesRollup.product,
+    'type': SalesRollup.type,
+    'day': SalesRollup.day,
+}
+
+
+@api.route('/reports/<any(product, type, day):group>', methods=['GET'])
+def reports(group):
+    rows, error = sales_report(group, request.args)
+    if error:
+        return error
+    return jsonify({"report": rows})
+
+
+@api.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({"product_cache": product_cache.stats(), "order_cache": order_cache.stats()})
+
+
+# The functions below hold the order logic without touching the request or doing any network call,
+# so the same code backs the flask routes above and the async routes in asgi.py.
+# Errors are returned as (body, status) tuples, ready to be sent back as is.
+
+def request_client(headers, remote_addr):
+    # the api key when the client sends a known one, its address otherwise: a client making up keys would
+    # get a new bucket with each of them
+    api_key = headers.get('X-Api-Key')
+    if api_key in api_keys:
+        return "key:" + api_key
+    if trusted_proxies:
+        # each proxy appends the address it got the request from, the ones before them are the client's to make up
+        forwarded = [address.strip() for address in headers.get('X-Forwarded-For', '').split(',')]
+        if len(forwarded) >= trusted_proxies and forwarded[-trusted_proxies]:
+            remote_addr = forwarded[-trusted_proxies]
+    return "ip:" + str(remote_addr)
+
+
+def rejected_request(limiter, route, client):
+    # None when the request is admitted, otherwise the error to send back
+    rejected = limiter.admit(client, route)
+    if not rejected:
+        return None
+    status, retry_after = rejected
+    if status == 429:
+        error = errors.error_handler("request", "too-many-requests", "Trop de requêtes, réessayez plus tard")
+    else:
+        error = errors.error_handler("request", "server-busy", "Le serveur est occupé, réessayez plus tard")
+    return error, status, {"Retry-After": str(retry_after)}
+
+
+def create_order(payload, group_commit=False):
+    # returns (order, None) or (None, error)
+    if not payload:
+        return None, (errors.error_handler("products", "missing-fields",
+                                           "La création d'une commande nécessite un produit"), 422)
+
+    product_id = payload.get('id')
+    quantity = payload.get('quantity')
+
+    if not product_id or not quantity:
+        return None, (errors.error_handler("products", "missing-fields",
+                                           "La création d'une commande nécessite un produit et une quantité"), 422)
+
+    # check if product exists
+    product = get_product(product_id)
+    if not product:
+        return None, (errors.error_handler("order", "product-does-not-exist", "Le produit n'existe pas"), 404)
+
+    # check if product is in stock
+    if not product["in_stock"]:
+        return None, (errors.error_handler("products", "out-of-inventory",
+                                           "Le produit demandé n'est pas en inventaire"), 422)
+
+    # check if quantity is valid
+    if quantity < 1:
+        return None, (errors.error_handler("order", "invalid-quantity",
+                                           "La quantité ne peut pas être inférieure à 1"), 422)
+
+    # create order
+    try:
+        if group_commit:
+            new_order = get_order_writer().submit(insert_order, product_id, quantity)
+        else:
+            new_order = insert_order(product_id, quantity)
+    except peewee.IntegrityError as e:
+        print(e)
+        return None, (errors.error_handler("order", "invalid-fields", "Les champs sont mal remplis"), 422)
+
+    # committed by now, the redirected GET finds it in the cache
+    order_cache.set(new_order.id, [new_order.version, order_document(new_order)])
+    return new_order, None
+
+
+def insert_order(product_id, quantity):
+    # the returned order has everything order_document() needs
+    new_order = Order.create(product_id=product_id)
+    new_order.line = OrderProduct.create(order_id=new_order.id, product_id=product_id, quantity=quantity)
+    return new_order
+
+
+def get_order_writer():
+    # started on first use, so each forked worker gets its own writer thread
+    global _order_writer
+    with _order_writer_lock:
+        if _order_writer is None:
+            _order_writer = GroupCommitWriter(db)
+    return _order_writer
+
+
+def close_order_writer():
+    global _order_writer
+    with _order_writer_lock:
+        if _order_writer is not None:
+            _order_writer.close()
+            _order_writer = None
+
+
+def order_query():
+    # orders with their product line, shipping info, credit card and transaction, all in one query
+    # the products come from get_product()
+    return (Order
+            .select(Order, OrderProduct, ShippingInfo, CreditCard, Transaction)
+            .join(OrderProduct, on=(OrderProduct.order == Order.id), attr='line')
+            .switch(Order)
+            .join(ShippingInfo, peewee.JOIN.LEFT_OUTER)
+            .switch(Order)
+            .join(CreditCard, peewee.JOIN.LEFT_OUTER)
+            .switch(Order)
+            .join(Transaction, peewee.JOIN.LEFT_OUTER))
+
+
+def load_order(order_id):
+    # the order document, or None if there is no such order, archived orders included
+    entry = load_order_entry(order_id)
+    return entry[1] if entry else None
+
+
+def load_order_entry(order_id):
+    # [version, document] as stored in the cache, archived orders can't change and have no version
+    order = order_query().where(Order.id == order_id).get_or_none()
+    if order:
+        return [order.version, order_document(order)]
+    archived = ArchivedOrder.get_or_none(ArchivedOrder.id == order_id)
+    return [None, json.loads(archived.document)] if archived else None
+
+
+def cached_order(order_id):
+    # load_order() through the cache
+    entry = order_cache.get(order_id)
+    # a cache kept in this process isn't updated by the writes other workers make, the order's version says
+    # whether the document is still current, one primary key lookup instead of loading the whole order
+    local = isinstance(order_cache, LRUCache)
+    if entry is not None and local:
+        if Order.select(Order.version).where(Order.id == order_id).scalar() != entry[0]:
+            entry = None
+    if entry is None:
+        entry = load_order_entry(order_id)
+        if entry is None:
+            return None
+        if local:
+            # the version comes from the same query as the document, a wrong guess is caught on the next read
+            order_cache.set(order_id, entry)
+        else:
+            # add, not set: a write that happened while this was loading stored a newer document, it wins
+            order_cache.add(order_id, entry)
+    return entry[1]
+
+
+def refresh_order(order_id):
+    # called after every write to an order, returns its new document
+    # the version is bumped once the write is done: a worker reading in between may cache the new document
+    # under the old version, it reloads it on its next read
+    Order.update(version=Order.version + 1).where(Order.id == order_id).execute()
+    entry = load_order_entry(order_id)
+    if entry is None:
+        order_cache.delete(order_id)
+        return None
+    order_cache.set(order_id, entry)
+    return entry[1]
+
+
+def missing_order_error(order_id):
+    # PUT on an order that isn't in the main tables
+    if ArchivedOrder.get_or_none(ArchivedOrder.id == order_id):
+        return errors.error_handler("order", "order-archived", "La commande est archivée et ne peut plus"
+                                                               " être modifiée"), 422
+    return errors.error_handler("order", "order-not-found", "L'order n'existe pas"), 404
+
+
+def order_document(order):
+    # order must come from order_query(), nothing here hits the database
+    from playhouse.shortcuts import model_to_dict
+
+    line = order.line
+    product = get_product(line.product_id)
+    total_price, shipping_price = cart_totals([(product["price"], product["weight"], line.quantity)])
+    order_dict = {
+        "id": order.id,
+        "email": order.email,
+        "paid": order.paid,
+        "product": {
+            "id": product["id"],
+            "quantity": line.quantity
+        },
+        "total_price": total_price,
+        "shipping_price": shipping_price,
+        "shipping_info": {},
+        "credit_card": {},
+        "transaction": {},
+    }
+
+    # no need to send the shipping info and credit card ids to client
+    if order.shipping_info_id:
+        order_dict["shipping_info"] = model_to_dict(order.shipping_info, exclude=[ShippingInfo.id])
+    if order.credit_card_id:
+        order_dict["credit_card"] = model_to_dict(order.credit_card, exclude=[CreditCard.id])
+    if order.transaction_id:
+        order_dict["transaction"] = model_to_dict(order.transaction)
+
+    return order_dict
+
+
+def update_shipping_order(order, data):
+    # returns an error or None, raises ValueError on missing keys
+    if not all(key in data for key in ("shipping_information", "email")):
+        raise ValueError
+    shipping_info = data["shipping_information"]
+    if not all(key in shipping_info for key in ("address", "city", "province", "postal_code", "country")):
+        raise ValueError
+
+        # Check if shipping info exists
+    if order.shipping_info_id:
+        # Update shipping info instance
+        ShippingInfo.update(**shipping_info).where(ShippingInfo.id == order.shipping_info_id).execute()
     else:
-        return 25
+        # Create new shipping info instance
+        try:
+            shipping_info_instance = ShippingInfo.create(**shipping_info)
+            order.shipping_info = shipping_info_instance
+        except peewee.IntegrityError:
+            return errors.error_handler("orders", "invalid-fields",
+                                        "Les informations d'achat ne sont pas correctes"), 422
+
+    # Update order email and save, only the columns written here: the order was read when the request started
+    # and the version (see refresh_order) or other columns may have been changed since
+    order.email = data["email"]
+    try:
+        order.save(only=[Order.email, Order.shipping_info])
+    except peewee.IntegrityError:
+        return errors.error_handler("orders", "invalid-fields",
+                                    "Les informations d'achat ne sont pas correctes"), 422
+
+    return None
+
+
+def prepare_payment(order, data):
+    # returns (payload for the payment gateway, None) or (None, error)
+    if order.paid:
+        return None, (errors.error_handler("order", "already-paid", "La commande a deja ete payé"), 422)
+
+    if not all(key in data for key in ("name", "number", "expiration_year", "cvv", "expiration_month")):
+        return None, (errors.error_handler("credit-card", "missing-fields", "Il manque des champs dans le json"), 422)
+
+    if order.email is None or order.shipping_info is None:
+        return None, (errors.error_handler("order", "missing-fields",
+                                           "Les informations du client sont nécessaire avant"
+                                           " d'appliquer une carte de crédit"), 422)
+
+    if not (data["number"] == "4000 0000 0000 0002" or data["number"] == "4242 4242 4242 4242"):
+        return None, (errors.error_handler("credit-card", "incorrect-number", "Le numéro de carte est invalide"), 422)
+
+    order_product = OrderProduct.get_or_none(OrderProduct.order == order)
+
+    if not order_product:
+        return None, (errors.error_handler("order", "unknown-error", "contactez l'administrateur du site"), 418)  # :)
+        # please don't remove this
+
+    product = get_product(order_product.product_id)
+    total_price, shipping_price = cart_totals([(product["price"], product["weight"], order_product.quantity)])
+    pay_payload = {
+        "credit_card": {**data},
+        "amount_charged": total_price + shipping_price,
+    }
+    return pay_payload, None
+
+
+def record_payment(order, data, transaction):
+    # called once the payment gateway accepted the card, returns an error or None
+    with db.atomic():
+        # Create transaction
+        order.transaction = Transaction.create(**transaction)
+        order.paid = True
+        order.paid_at = datetime.datetime.now()
+        # the order was read before the gateway call, writes made meanwhile must be kept
+        order.save(only=[Order.transaction, Order.paid, Order.paid_at])
+        order_product = OrderProduct.get(OrderProduct.order == order)
+        product = get_product(order_product.product_id)
+        revenue, shipping = cart_totals([(product["price"], product["weight"], order_product.quantity)])
+        add_to_rollup(order.paid_at.date(), product["id"], product["type"], order_product.quantity, revenue,
+                      shipping)
+
+    # add credit card to order
+    try:
+        credit_card = CreditCard.create(name=data["name"], first_digits=data["number"][:4],
+                                        last_digits=data["number"][-4:],
+                                        expiration_year=data["expiration_year"],
+                                        expiration_month=data["expiration_month"])
+        order.credit_card = credit_card
+        order.save(only=[Order.credit_card])
+    except peewee.IntegrityError:
+        return errors.error_handler("credit-card", "invalid-fields",
+                                    "Les informations de la carte de crédit ne sont pas correctes"), 400
+
+    return None
+
+
+MAX_QUOTE_CARTS = 1000
+
+ORDERS_PAGE_SIZE = 50
+ORDERS_MAX_PAGE_SIZE = 500
+# orders fetched per query when exporting
+EXPORT_BATCH = 500
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+CSV_COLUMNS = ["id", "created_at", "email", "paid", "product_id", "quantity", "total_price", "shipping_price",
+               "country", "address", "postal_code", "city", "province", "transaction_id", "amount_charged"]
+
+
+def filter_orders(args):
+    # returns ((where clauses on Order, where clauses on ArchivedOrder), None) or (None, error) from the /orders
+    # query string. The archived orders are all paid and only have their document to filter on
+    clauses = []
+    archived = []
+    try:
+        if 'paid' in args:
+            if args['paid'] not in ('true', 'false'):
+                raise ValueError
+            clauses.append(Order.paid == (args['paid'] == 'true'))
+            if args['paid'] == 'false':
+                archived.append(peewee.SQL('0'))
+        if 'email' in args:
+            clauses.append(Order.email == args['email'])
+            archived.append(peewee.fn.json_extract(ArchivedOrder.document, '$.email') == args['email'])
+        if 'product' in args:
+            clauses.append(Order.product == int(args['product']))
+            archived.append(peewee.fn.json_extract(ArchivedOrder.document, '$.product.id') == int(args['product']))
+        if 'from' in args:
+            clauses.append(Order.created_at >= datetime.datetime.fromisoformat(args['from']))
+            archived.append(ArchivedOrder.created_at >= datetime.datetime.fromisoformat(args['from']))
+        if 'to' in args:
+            clauses.append(Order.created_at < datetime.datetime.fromisoformat(args['to']))
+            archived.append(ArchivedOrder.created_at < datetime.datetime.fromisoformat(args['to']))
+    except ValueError:
+        return None, (errors.error_handler("orders", "invalid-filters", "Les filtres ne sont pas valides"), 422)
+    return (clauses, archived), None
+
+
+def orders_page(where, args):
+    # returns (GET /orders body, None) or (None, error), where comes from filter_orders()
+    try:
+        limit = min(int(args.get('limit', ORDERS_PAGE_SIZE)), ORDERS_MAX_PAGE_SIZE)
+        after = int(args.get('after', 0))
+    except ValueError:
+        return None, (errors.error_handler("orders", "invalid-filters", "La pagination n'est pas valide"), 422)
+    if limit < 1:
+        return None, (errors.error_handler("orders", "invalid-filters", "La pagination n'est pas valide"), 422)
+
+    # keyset pagination, one extra row tells if there is a next page
+    rows = order_rows(where, after, limit + 1)
+    page = rows[:limit]
+    return {
+        "orders": page,
+        "next": page[-1]["id"] if len(rows) > limit else None,
+    }, None
+
+
+def order_rows(where, after, limit):
+    # the first `limit` orders after the id `after` matching where (from filter_orders), archived ones included
+    clauses, archived = where
+    rows = [order_row(order)
+            for order in order_query().where(*clauses, Order.id > after).order_by(Order.id).limit(limit)]
+    rows += [archived_order_row(order)
+             for order in (ArchivedOrder.select()
+                           .where(*archived, ArchivedOrder.id > after)
+                           .order_by(ArchivedOrder.id)
+                           .limit(limit))]
+    rows.sort(key=lambda row: row["id"])
+    return rows[:limit]
+
+
+def order_row(order):
+    row = order_document(order)
+    row["created_at"] = order.created_at.isoformat()
+    return row
+
+
+def archived_order_row(archived):
+    row = json.loads(archived.document)
+    row["created_at"] = archived.created_at.isoformat()
+    return row
+
+
+def export_orders(where, export):
+    # walks the matching orders by id, EXPORT_BATCH at a time, so memory use doesn't depend on the table size
+    # yields bytes, compression.compress_stream doesn't take text
+    if export == 'csv':
+        yield (','.join(CSV_COLUMNS) + '\n').encode()
+    after = 0
+    while True:
+        rows = order_rows(where, after, EXPORT_BATCH)
+        if not rows:
+            return
+        after = rows[-1]["id"]
+        if export == 'ndjson':
+            yield ''.join(json.dumps(row, sort_keys=True) + '\n' for row in rows).encode()
+        else:
+            yield csv_lines(rows).encode()
+
+
+def csv_lines(rows):
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    for row in rows:
+        writer.writerow([row["id"], row["created_at"], row["email"], row["paid"], row["product"]["id"],
+                         row["product"]["quantity"], row["total_price"], row["shipping_price"]] +
+                        [row["shipping_info"].get(key) for key in ("country", "address", "postal_code", "city",
+                                                                   "province")] +
+                        [row["transaction"].get("id"), row["transaction"].get("amount_charged")])
+    return out.getvalue()
+
+
+ARCHIVE_BATCH = 500
+
+
+def archive_orders(before, batch_size=ARCHIVE_BATCH):
+    # moves the orders paid and created before `before` to the archive, batch_size orders per transaction
+    # returns how many orders were moved
+    moved = 0
+    # sqlite hands out max(id) + 1 to the next order, the last order always stays so ids are never reused
+    last_id = Order.select(peewee.fn.MAX(Order.id)).scalar()
+    after = 0
+    while True:
+        orders = list(order_query()
+                      .where(Order.paid == True, Order.created_at < before, Order.id > after,  # noqa: E712
+                             Order.id != last_id)
+                      .order_by(Order.id)
+                      .limit(batch_size))
+        if not orders:
+            return moved
+        after = orders[-1].id
+        ids = [order.id for order in orders]
+
+        with db.atomic():
+            ArchivedOrder.insert_many([{
+                "id": order.id,
+                "created_at": order.created_at,
+                "paid_at": order.paid_at,
+                "document": json.dumps(order_document(order)),
+            } for order in orders]).execute()
+            OrderProduct.delete().where(OrderProduct.order.in_(ids)).execute()
+            Order.delete().where(Order.id.in_(ids)).execute()
+            ShippingInfo.delete().where(
+                ShippingInfo.id.in_([order.shipping_info_id for order in orders if order.shipping_info_id])
+            ).execute()
+            CreditCard.delete().where(
+                CreditCard.id.in_([order.credit_card_id for order in orders if order.credit_card_id])
+            ).execute()
+            Transaction.delete().where(
+                Transaction.id.in_([order.transaction_id for order in orders if order.transaction_id])
+            ).execute()
+        moved += len(orders)
+
+
+def add_to_rollup(day, product_id, product_type, quantity, revenue, shipping):
+    (SalesRollup
+     .insert(day=day, product=product_id, type=product_type, orders=1, quantity=quantity, revenue=revenue,
+             shipping=shipping)
+     .on_conflict(conflict_target=[SalesRollup.day, SalesRollup.product],
+                  update={SalesRollup.orders: SalesRollup.orders + 1,
+                          SalesRollup.quantity: SalesRollup.quantity + quantity,
+                          SalesRollup.revenue: SalesRollup.revenue + revenue,
+                          SalesRollup.shipping: SalesRollup.shipping + shipping})
+     .execute())
+
+
+def rebuild_rollups():
+    # recompute the rollups from the paid orders, on the day they were paid like record_payment() does
+    with db.atomic():
+        SalesRollup.delete().execute()
+        paid = (OrderProduct
+                .select(OrderProduct, Order, Product)
+                .join(Order)
+                .switch(OrderProduct)
+                .join(Product)
+                .where(Order.paid == True))  # noqa: E712
+        for order_product in paid.iterator():
+            product = order_product.product
+            revenue, shipping = cart_totals([(product.price, product.weight, order_product.quantity)])
+            add_to_rollup(order_product.order.paid_at.date(), product.id, product.type, order_product.quantity,
+                          revenue, shipping)
+
+        products = {product.id: product for product in Product.select()}
+        for archived in ArchivedOrder.select().iterator():
+            document = json.loads(archived.document)
+            product = products[document["product"]["id"]]
+            add_to_rollup(archived.paid_at.date(), product.id, product.type, document["product"]["quantity"],
+                          document["total_price"], document["shipping_price"])
+
+
+def sales_report(group, args):
+    # returns (rows, None) or (None, error), group is one of REPORT_GROUPS
+    key = REPORT_GROUPS[group]
+    query = (SalesRollup
+             .select(key.alias(group),
+                     peewee.fn.SUM(SalesRollup.orders).alias('orders'),
+                     peewee.fn.SUM(SalesRollup.quantity).alias('quantity'),
+                     peewee.fn.SUM(SalesRollup.revenue).alias('revenue'),
+                     peewee.fn.SUM(SalesRollup.shipping).alias('shipping'))
+             .group_by(key)
+             .order_by(key))
+    try:
+        if 'from' in args:
+            query = query.where(SalesRollup.day >= datetime.date.fromisoformat(args['from']))
+        if 'to' in args:
+            query = query.where(SalesRollup.day < datetime.date.fromisoformat(args['to']))
+    except ValueError:
+        return None, (errors.error_handler("reports", "invalid-filters", "Les filtres ne sont pas valides"), 422)
+
+    rows = list(query.dicts())
+    if group == 'day':
+        for row in rows:
+            row['day'] = row['day'].isoformat()
+    return rows, None
+
+
+# shipping is 5$ under 500g, 10$ under 2kg and 25$ above
+SHIPPING_THRESHOLDS = [500, 2000]
+SHIPPING_PRICES = [5, 10, 25]
+
+
+def calculate_shipping_price(weight):
+    return SHIPPING_PRICES[bisect.bisect_right(SHIPPING_THRESHOLDS, weight)]
+
+
+def calculate_shipping_prices(weights):
+    # same as calculate_shipping_price for a whole list of weights
+    thresholds, prices = SHIPPING_THRESHOLDS, SHIPPING_PRICES
+    return [prices[bisect.bisect_right(thresholds, weight)] for weight in weights]
+
+
+def cart_totals(lines):
+    # lines are (price, weight, quantity), the price of the products and the shipping on their total weight
+    total_price, weight = cart_price_and_weight(lines)
+    return total_price, calculate_shipping_price(weight)
+
+
+def cart_price_and_weight(lines):
+    total_price = sum(price * quantity for price, _, quantity in lines)
+    weight = sum(weight * quantity for _, weight, quantity in lines)
+    return total_price, weight
+
+
+def check_carts(carts):
+    # the error for a POST /quote payload that can't be priced at all, or None
+    if not carts or not isinstance(carts, list):
+        return errors.error_handler("quote", "missing-fields", "Il faut au moins un panier"), 422
+    if len(carts) > MAX_QUOTE_CARTS:
+        return errors.error_handler("quote", "too-many-carts",
+                                    "Pas plus de %d paniers par requête" % MAX_QUOTE_CARTS), 422
+    return None
+
+
+def quote_carts(carts):
+    # prices every cart from the in-memory catalog, nothing is written
+    # returns one quote per cart, either its totals or the error that cart would get from POST /order
+    products = get_catalog_store()
+    quotes = []
+    weights = []
+    for cart in carts:
+        quote, weight = quote_cart(cart, products)
+        quotes.append(quote)
+        weights.append(weight)
+
+    # shipping for all the valid carts in one pass
+    priced = [i for i, quote in enumerate(quotes) if "errors" not in quote]
+    for i, shipping_price in zip(priced, calculate_shipping_prices([weights[i] for i in priced])):
+        quotes[i]["shipping_price"] = shipping_price
+    return quotes
+
+
+def quote_cart(cart, products):
+    # returns (quote without shipping, total weight)
+    lines = cart.get("products") if isinstance(cart, dict) else None
+    if not lines or not isinstance(lines, list):
+        return errors.error_handler("products", "missing-fields", "Le panier nécessite au moins un produit"), 0
+
+    priced_lines = []
+    for line in lines:
+        # same checks, in the same order, as create_order()
+        if not isinstance(line, dict) or not line.get("id") or not line.get("quantity"):
+            return errors.error_handler("products", "missing-fields",
+                                        "La création d'une commande nécessite un produit et une quantité"), 0
+        quantity = line["quantity"]
+        product = products.get(line["id"])
+        if not product:
+            return errors.error_handler("order", "product-does-not-exist", "Le produit n'existe pas"), 0
+        if not product["in_stock"]:
+            return errors.error_handler("products", "out-of-inventory",
+                                        "Le produit demandé n'est pas en inventaire"), 0
+        if not isinstance(quantity, int) or quantity < 1:
+            return errors.error_handler("order", "invalid-quantity",
+                                        "La quantité ne peut pas être inférieure à 1"), 0
+        priced_lines.append((product["price"], product["weight"], quantity))
+
+    total_price, weight = cart_price_and_weight(priced_lines)
+    return {"products": lines, "total_price": total_price}, weight
 
 
 def populate_database(debug=False):
-    # create products from url and add to database (only if database is empty)
-    if Product.select().count() == 0:
-        response = requests.get('http://dimprojetu.uqac.ca/~jgnault/shops/products/')
-        products = json.loads(response.content)
-        for product in products["products"]:
-            if debug:
-                print("Adding product: " + product["name"])
-            product = dict_to_model(Product, product)
-            # loops through all the fields in the model and sets them to the values in the dict
-            try:
-                Product.create(**product.__dict__['__data__'])
-            except peewee.IntegrityError as e:
-                print("invalid product: " + product.name)
-                print("Error: " + str(e))
-
-
-@app.cli.command("init-db")
+    # create products (only if database is empty), from the local snapshot when there is one, from url otherwise
+    # returns True when the products came from the snapshot and may be outdated
+    if Product.select().count() != 0:
+        return False
+    products = load_catalog_snapshot()
+    from_snapshot = products is not None
+    if not from_snapshot:
+        products = fetch_catalog()
+        save_catalog_snapshot(products)
+    save_products(products, debug)
+    return from_snapshot
+
+
+def fetch_catalog():
+    import requests
+
+    response = requests.get(CATALOG_URL)
+    return json.loads(response.content)["products"]
+
+
+def load_catalog_snapshot():
+    try:
+        with open(catalog_snapshot) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_catalog_snapshot(products):
+    # written aside then renamed, readers never see half a file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(catalog_snapshot)),
+                               prefix=os.path.basename(catalog_snapshot) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(products, f)
+        os.replace(tmp, catalog_snapshot)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def save_products(products, debug=False, complete=False):
+    # inserts or replaces the products, invalid ones are skipped
+    # complete: products is the whole catalog, the ones missing from it can't be ordered anymore. They are
+    # kept, the orders and reports still point at them
+    from playhouse.shortcuts import dict_to_model
+
+    for product in products:
+        if debug:
+            print("Adding product: " + product["name"])
+        product = dict_to_model(Product, product)
+        # loops through all the fields in the model and sets them to the values in the dict
+        try:
+            with db.atomic():
+                Product.insert(**product.__dict__['__data__']).on_conflict_replace().execute()
+        except peewee.IntegrityError as e:
+            print("invalid product: " + product.name)
+            print("Error: " + str(e))
+    if complete:
+        (Product
+         .update(in_stock=False)
+         .where(Product.id.not_in([product["id"] for product in products]))
+         .execute())
+    build_catalog_store()
+    invalidate_catalog()
+
+
+def refresh_catalog():
+    # fetches the remote catalog and updates the products and the snapshot, workers notice the new snapshot
+    # and rebuild their catalog (see check_catalog_version)
+    try:
+        products = fetch_catalog()
+    except Exception as e:
+        print("catalog refresh failed: " + str(e))
+        return
+    try:
+        save_products(products, complete=True)
+        save_catalog_snapshot(products)
+    finally:
+        db.close()
+
+
+def start_catalog_refresh():
+    thread = threading.Thread(target=refresh_catalog, name="catalog-refresh", daemon=True)
+    thread.start()
+    return thread
+
+
+@api.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    rebuild_rollups()
+
+
+@api.cli.command("archive-orders")
+@click.option("--days", default=90, help="archive the paid orders older than this")
+def archive_orders_command(days):
+    moved = archive_orders(datetime.datetime.now() - datetime.timedelta(days=days))
+    print("archived %d orders" % moved)
+
+
+@api.cli.command("init-db")
 def init_db():
     db.connect()
-    db.drop_tables([Product, ShippingInfo, Transaction, CreditCard, Order, OrderProduct])
-    db.create_tables([Product, ShippingInfo, Transaction, CreditCard, Order, OrderProduct])
+    db.drop_tables(MODELS)
+    # order ids start over, a shared cache would still hold the old documents
+    order_cache.clear()
+    db.create_tables(MODELS)
     populate_database()
 
 
+def setup_db(refresh=True):
+    # create missing tables and load the catalog, existing orders are kept
+    # refresh: fetch the remote catalog in the background, the products come from the snapshot or from the
+    # last start and may be outdated. Returns the refresh thread, if any
+    # a process forked while the refresh is running could inherit its locks, serve.py refreshes in a worker
+    db.connect(reuse_if_open=True)
+    # several servers may start at once (hypercorn workers), they migrate one after the other
+    with db.atomic('IMMEDIATE'):
+        migrate_db()
+        db.create_tables(MODELS, safe=True)
+    populate_database()
+    # mapped before forking, workers share its pages
+    build_catalog_store()
+    warm_catalog()
+    # don't leak this connection into forked workers
+    db.close()
+    if refresh:
+        return start_catalog_refresh()
+    return None
+
+
+def migrate_db():
+    # add the columns that came after the first version of the schema, must run before create_tables()
+    # creates their indexes
+    if not Order.table_exists():
+        return
+    columns = [column.name for column in db.get_columns(Order._meta.table_name)]
+    if 'created_at' not in columns:
+        # sqlite can't add a NOT NULL column without a constant default, existing orders get the migration date
+        db.execute_sql('ALTER TABLE "order" ADD COLUMN "created_at" DATETIME')
+        Order.update(created_at=datetime.datetime.now()).execute()
+    if 'paid_at' not in columns:
+        # the payment date wasn't kept, paid orders count on their creation day
+        db.execute_sql('ALTER TABLE "order" ADD COLUMN "paid_at" DATETIME')
+        Order.update(paid_at=Order.created_at).where(Order.paid == True).execute()  # noqa: E712
+    if 'version' not in columns:
+        db.execute_sql('ALTER TABLE "order" ADD COLUMN "version" INTEGER NOT NULL DEFAULT 0')
+    if ArchivedOrder.table_exists() and 'paid_at' not in [
+            column.name for column in db.get_columns('archived_order', schema='archive')]:
+        db.execute_sql('ALTER TABLE "archive"."archived_order" ADD COLUMN "paid_at" DATETIME')
+        ArchivedOrder.update(paid_at=ArchivedOrder.created_at).execute()
+    if not SalesRollup.table_exists():
+        db.create_tables([SalesRollup, ArchivedOrder], safe=True)
+        rebuild_rollups()
+
+
 def delete_db():
-    db.drop_tables([Product, ShippingInfo, Transaction, CreditCard, Order, OrderProduct])
+    db.drop_tables(MODELS)
+    order_cache.clear()
     db.close()
 
 
 if __name__ == "__main__":
-    init_db()
+    app = create_app()
+    setup_db()
     app.run()
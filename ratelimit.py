@@ -0,0 +1,144 @@
+# admission control: token buckets per client and per route, plus a cap on the requests served at once
+#
+#   limiter = RateLimiter(MemoryStore(), {"POST /order": (2, 10), "*": (20, 40)}, max_active=64)
+#   rejected = limiter.admit(client, "POST /order")     # None, or (status, seconds to wait)
+#   ...
+#   limiter.done()                                      # once an admitted request is over
+#
+# a limit is (tokens per second, bucket size): a client can send up to `bucket size` requests at once, then
+# `tokens per second` on average. "*" applies to the routes without their own limit.
+# MemoryStore keeps the buckets in the process, so each gunicorn worker counts on its own. RedisStore keeps
+# them in redis (pip install redis) where every worker and every host shares them. Any object with the same
+# take() can stand in for either.
+
+import collections
+import math
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryStore:
+    # keeps the max_keys most recently used buckets, the others are dropped
+    def __init__(self, max_keys=10000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        # least recently used first
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        # takes a token, returns 0 or how many seconds until there is one
+        with self._lock:
+            now = self.clock()
+            tokens, stamp = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - stamp) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            # one bucket at most per call, the cost doesn't grow with the number of clients. A dropped bucket
+            # starts over full, the least recently used one is the likeliest to be full already
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+# same computation as MemoryStore.take, run atomically by redis with its own clock
+_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens = tonumber(bucket[1]) or burst
+local stamp = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - stamp) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'stamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisStore:
+    # timeout in seconds: a slow redis lets requests through unlimited rather than holding them up
+    def __init__(self, url, prefix="ratelimit:", timeout=0.1):
+        if redis is None:
+            raise RuntimeError("RedisStore needs the redis package")
+        self.prefix = prefix
+        client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self._take = client.register_script(_TAKE_SCRIPT)
+
+    def take(self, key, rate, burst):
+        try:
+            return float(self._take(keys=[self.prefix + key], args=[rate, burst]))
+        except redis.RedisError:
+            # redis being down or slow must not take the api down with it, requests go through unlimited
+            return 0
+
+
+class ConcurrencyLimit:
+    # a semaphore that refuses instead of waiting
+    def __init__(self, max_active):
+        self.max_active = max_active
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.active >= self.max_active:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+
+class RateLimiter:
+    def __init__(self, store, limits, max_active=None):
+        self.store = store
+        self.limits = limits
+        self.concurrency = ConcurrencyLimit(max_active) if max_active else None
+
+    def admit(self, client, route):
+        # None when the request may go on (call done() once it is over), otherwise (status, retry after)
+        limit = self.limits.get(route, self.limits.get("*"))
+        if limit:
+            wait = self.store.take(route + "|" + client, *limit)
+            if wait > 0:
+                return 429, retry_after(wait)
+        if self.concurrency and not self.concurrency.acquire():
+            return 503, 1
+        return None
+
+    def done(self):
+        if self.concurrency:
+            self.concurrency.release()
+
+
+def retry_after(seconds):
+    # Retry-After only takes whole seconds
+    return max(1, math.ceil(seconds))
+
+
+def create_limiter(config):
+    # None when there is nothing to limit
+    if not config['RATE_LIMITS'] and not config['MAX_ACTIVE_REQUESTS']:
+        return None
+    store = RedisStore(config['RATE_LIMIT_STORE']) if config['RATE_LIMIT_STORE'] else MemoryStore()
+    return RateLimiter(store, config['RATE_LIMITS'], config['MAX_ACTIVE_REQUESTS'])
@@ -0,0 +1,115 @@
+# production entry point, runs the api behind gunicorn instead of the flask dev server
+#
+#   python serve.py --workers 4 --threads 2
+#   gunicorn -c serve.py --preload 'serve:create_app()'
+#
+# the database is never dropped here (use `flask --app inf349 init-db` for that), tables are only created
+# when missing and the catalog is loaded and serialized once in the master before the workers are forked.
+# The remote catalog is then fetched by the first worker
+
+import argparse
+import multiprocessing
+
+from gunicorn.app.base import BaseApplication
+
+import inf349
+
+
+def create_app(config=None):
+    # gunicorn factory, combine with --preload so the setup runs once in the master
+    app = inf349.create_app(config)
+    # the refresh writes to the database from a thread, it must not run in the process the workers fork from
+    inf349.setup_db(refresh=False)
+    return app
+
+
+def post_worker_init(worker):
+    # only the first worker refreshes the catalog, the others notice the new snapshot (see check_catalog_version)
+    if worker.age == 1:
+        inf349.start_catalog_refresh()
+
+
+def worker_exit(server, worker):
+    # commit the queued orders and close the worker's sqlite connection on graceful shutdown
+    inf349.close_order_writer()
+    inf349.db.close()
+
+
+class Server(BaseApplication):
+    def __init__(self, application, options=None):
+        self.application = application
+        self.options = options or {}
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def default_workers():
+    return multiprocessing.cpu_count() * 2 + 1
+
+
+def rate_limit(value):
+    # "POST /order=2/10" -> ("POST /order", (2.0, 10))
+    route, _, limit = value.rpartition("=")
+    rate, _, burst = limit.partition("/")
+    try:
+        return route, (float(rate), int(burst))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected ROUTE=RATE/BURST, got %r" % value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the inf349 api with gunicorn")
+    parser.add_argument("--bind", default="127.0.0.1:5000")
+    parser.add_argument("--workers", type=int, default=default_workers())
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--timeout", type=int, default=30)
+    parser.add_argument("--graceful-timeout", type=int, default=30)
+    parser.add_argument("--group-commit", action="store_true",
+                        help="batch concurrent order creations into shared transactions")
+    parser.add_argument("--rate-limit", type=rate_limit, action="append", default=[],
+                        help='token bucket per client for a route, e.g. "POST /order=2/10" or "*=20/40"')
+    parser.add_argument("--rate-limit-store", help="redis url to share the buckets between workers")
+    parser.add_argument("--api-keys", type=argparse.FileType(),
+                        help="file with one api key per line, clients sending one in X-Api-Key get their own "
+                             "buckets")
+    parser.add_argument("--trusted-proxies", type=int, default=0,
+                        help="reverse proxies in front of the api, the client address is read from "
+                             "X-Forwarded-For")
+    parser.add_argument("--max-active-requests", type=int,
+                        help="requests served at once per worker, the others get a 503")
+    parser.add_argument("--order-cache-url", help="redis url to share the order documents between workers")
+    args = parser.parse_args(argv)
+
+    options = {
+        "bind": args.bind,
+        "workers": args.workers,
+        "threads": args.threads,
+        # gthread keeps a pool of threads per worker, sync is one request at a time
+        "worker_class": "gthread" if args.threads > 1 else "sync",
+        "timeout": args.timeout,
+        "graceful_timeout": args.graceful_timeout,
+        "preload_app": True,
+        "post_worker_init": post_worker_init,
+        "worker_exit": worker_exit,
+    }
+    config = {
+        'GROUP_COMMIT': args.group_commit,
+        'RATE_LIMITS': dict(args.rate_limit),
+        'RATE_LIMIT_STORE': args.rate_limit_store,
+        'MAX_ACTIVE_REQUESTS': args.max_active_requests,
+        'API_KEYS': [line.strip() for line in args.api_keys if line.strip()] if args.api_keys else (),
+        'TRUSTED_PROXIES': args.trusted_proxies,
+        'ORDER_CACHE_URL': args.order_cache_url,
+    }
+    Server(create_app(config), options).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# request coalescing: concurrent calls for the same key share a single computation
+#
+#   flight = SingleFlight()
+#   flight.do(("order", 1), load_order, 1)
+#
+# the first caller runs the function, the ones arriving while it runs wait and get the same result (or
+# exception) instead of running it again. Nothing is kept once the call is over, this is not a cache.
+#
+#   flight = AsyncSingleFlight()
+#   await flight.do(("order", 1), load_order_async, 1)
+#
+# the same for coroutines, the waiting callers are suspended coroutines instead of blocked threads
+
+import asyncio
+import threading
+import weakref
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self.forget(key, call)
+            call.done.set()
+
+    def forget(self, key, call=None):
+        # callers arriving after this start a new computation, used after a write so that reads don't join
+        # a computation that started before it
+        with self._lock:
+            if key in self._calls and (call is None or self._calls[key] is call):
+                del self._calls[key]
+
+
+class AsyncSingleFlight:
+    def __init__(self):
+        # tasks can only be awaited from their own event loop, each loop has its calls
+        self._loops = weakref.WeakKeyDictionary()
+
+    def _calls(self):
+        return self._loops.setdefault(asyncio.get_running_loop(), {})
+
+    async def do(self, key, fn, *args):
+        # fn returns an awaitable
+        calls = self._calls()
+        task = calls.get(key)
+        if task is None:
+            task = calls[key] = asyncio.ensure_future(fn(*args))
+            task.add_done_callback(lambda _: self._forget(calls, key, task))
+        # a caller going away (client disconnected) must not cancel the call the others are waiting on
+        return await asyncio.shield(task)
+
+    def forget(self, key):
+        # same as SingleFlight.forget, must be called from the event loop
+        self._forget(self._calls(), key)
+
+    def _forget(self, calls, key, task=None):
+        if key in calls and (task is None or calls[key] is task):
+            del calls[key]